@@ -1,15 +1,29 @@
+import atexit
 import logging
+import math
 import os
+import unittest
 from Queue import Queue
-from datetime import datetime
-from threading import Thread
+from functools import partial
+from threading import Thread, Lock, Event, current_thread
 
 import mido
 import pygame
 from pygame import midi
 
+import automation
+import bandwidth
+import cache
+import clock
 import config
+import event
+import instrumentation
 import music
+import ports
+import scheduler
+import timers
+import voices
+from mixer import Mixer, ENVELOPE_STEP
 
 # from pygame import midi
 
@@ -25,6 +39,16 @@ dir_path = os.path.dirname(os.path.realpath(__file__))
 # noinspection PyUnresolvedReferences
 input_names = mido.get_output_names()
 
+ports.registry.lanes = config.LANES
+ports.registry.stop_modes = config.STOP_MODES
+if config.BANDWIDTH_BYTES_PER_SECOND > 0:
+    ports.registry.bandwidth = bandwidth.Bandwidth(config.BANDWIDTH_BYTES_PER_SECOND, config.BANDWIDTH_BURST,
+                                                   config.BANDWIDTH_DROP)
+
+instrumentation.recorder.enabled = config.INSTRUMENTATION_ENABLED
+if config.INSTRUMENTATION_ENABLED:
+    atexit.register(instrumentation.recorder.dump, config.INSTRUMENTATION_PATH)
+
 REFACE = 'reface DX'
 MPX = 'MPX16'
 USB_MIDI = 'USB Midi'
@@ -32,6 +56,9 @@ SIMPLE_SYNTH = 'SimpleSynth virtual input'
 
 CHANNEL_PARTITION = 8
 
+# The channel that percussive instruments are redirected to
+PERCUSSION_CHANNEL = 10
+
 VOLUME_MAX = 1.0
 VOLUME_MIN = 0.0
 VOLUME_DEFAULT = 1.0
@@ -44,17 +71,40 @@ PITCHWHEEL_MIN = -8191
 PITCHWHEEL_DEFAULT = 0
 PITCHWHEEL_MAX = 8191
 
-simple_port = None
+# The controller that sets the volume of a channel and the value synths start it at
+VOLUME_CONTROL = 7
+CONTROLLER_VOLUME_DEFAULT = 100
+
+# How long effects take to move continuous parameters such as pitch bend and modulation
+RAMP_SECONDS = config.AUTOMATION_RAMP
 
 # TODO: Consider passing the key tracker only into select tracks
 key_tracker = music.KeyTracker()
 
+timeline_cache = cache.TimelineCache(config.CACHE_DIRECTORY)
+
+# Plays every real time track from a single thread
+shared_mixer = Mixer()
+
+# Held while a hand off between tracks is set up or carried out so that a track cannot finish part way through
+hand_off_lock = Lock()
+
 
 class ChannelMapper(config.ChannelMapper):
     def __init__(self, name, track):
         super(ChannelMapper, self).__init__(name)
         self.track = track
-        self.mode = 0
+        self.__mode = 0
+
+    @property
+    def mode(self):
+        return self.__mode
+
+    @mode.setter
+    def mode(self, mode):
+        if mode != self.__mode:
+            self.__mode = mode
+            self.track.update_routing()
 
     def is_on_input_channel(self, message):
         return message.channel in self.input_channels
@@ -66,8 +116,7 @@ class ChannelMapper(config.ChannelMapper):
     def send_message(self, message):
         if hasattr(message, "channel") and message.channel in self.input_channels:
             if message.channel == self.current_channel or message.type != note_on:
-                message.channel = self.output_channel
-                self.track.send_message(message)
+                self.track.send_message(message.replace(channel=self.output_channel))
 
 
 # noinspection PyClassHasNoInit
@@ -128,54 +177,75 @@ class InstrumentGroup:
 
 def make_port(name):
     """
-    Create a port with the given name, defaulting to the SimpleSynth port otherwise
+    Get the shared port with the given name, defaulting to the SimpleSynth port otherwise
     :param name: The name of the port
     :return: A port through which midi messages can be sent
     """
     for input_name in input_names:
         if name in input_name:
             name = input_name
-    global simple_port
     try:
-        # noinspection PyUnresolvedReferences
-        return mido.open_output(name)
+        return ports.registry.open(name)
     except IOError:
         logging.warn("{} not found.".format(name))
-        if simple_port is None:
-            # noinspection PyUnresolvedReferences
-            simple_port = mido.open_output()
-        return simple_port
+        return ports.registry.open()
 
 
 def play_note_for_channel_note_velocity(channel=0, note=50, velocity=50):
-    keys_port.send(mido.Message(note_on, channel=channel, note=note, velocity=velocity))
+    keys_port.send(mido.Message(note_on, channel=channel, note=note, velocity=velocity), ports.EFFECTS)
 
 
 def play_note(note):
     keys_port.send(note)
 
 
-def set_program(channel=0, program=0):
-    keys_port.send(mido.Message('program_change', program=program, time=0, channel=channel))
+def set_program(channel=0, program=0, lane=None):
+    keys_port.send(mido.Message('program_change', program=program, time=0, channel=channel), lane)
 
 
 # print mido.get_output_names()
 try:
-    keys_port = mido.open_output("USB Midi ")
+    keys_port = ports.registry.open("USB Midi ")
     print "Using USB Midi port"
 except IOError as e:
     # logging.exception(e)
     try:
-        keys_port = mido.open_output("USB Midi MIDI 1")
+        keys_port = ports.registry.open("USB Midi MIDI 1")
     except IOError as e:
         # logging.exception(e)
         keys_port = make_port(REFACE)
         print "Using REFACE port"
 
 
+def use_port(port):
+    """
+    Send everything that would go to the keys port through another port instead, e.g. a ports.RecordingPort so that
+    playback can run without a midi device. Only channels created afterwards use the new port.
+    :param port: An OutputPort
+    """
+    global keys_port
+    keys_port = port
+
+
 # drum_port = make_port(MPX)
 
 
+def pitchwheel(value):
+    """
+    :param value: A pitch bend
+    :return: The nearest pitchwheel value in range
+    """
+    return min(max(int(round(value)), PITCHWHEEL_MIN), PITCHWHEEL_MAX)
+
+
+def quantize_volume(volume):
+    """
+    :param volume: A volume (0.0 - 1.0)
+    :return: The nearest volume that makes a difference to a velocity
+    """
+    return automation.byte(volume * 127) / 127.
+
+
 class Intervals:
     """Class used to apply set of intervals to a note, using the most likely key"""
 
@@ -185,7 +255,11 @@ class Intervals:
         :param intervals: A series of intervals. For example, [2, 4] would turn a note into a triad
         """
         self.intervals = intervals
+        self.harmony = music.HarmonyTable(intervals)
         self.playing_notes = set()
+        # Chords for every note in the last key seen
+        self.__key = None
+        self.__chords = None
 
     def __call__(self, msg):
         """
@@ -193,122 +267,323 @@ class Intervals:
         :param msg: A midi note_on message
         :return: An array of midi messages
         """
-        new_array = []
-
-        for interval in self.intervals:
-            new_msg = msg.copy()
-            note = key_tracker.scale.position_at_interval(msg.note, interval)
-            if 0 <= note <= 127:
-                new_msg.note = note
-                new_msg.time = 0
-                new_array.append(new_msg)
-
-                if new_msg.type == 'note_on':
-                    self.playing_notes.add(new_msg.note)
-                elif new_msg.type == 'note_off' and new_msg.note in self.playing_notes:
-                    self.playing_notes.remove(new_msg.note)
-
+        key = key_tracker.key
+        if key != self.__key:
+            self.__chords = self.harmony.row(key)
+            self.__key = key
+
+        chord = self.__chords[msg.note]
+        if chord is None:
+            # The note is not in the key so leave it as it is
+            return [msg]
+
+        new_array = [msg.replace(note=note) for note in chord]
+        if msg.type == 'note_on':
+            self.playing_notes.update(chord)
+        elif msg.type == 'note_off':
+            self.playing_notes.difference_update(chord)
         return new_array
 
     @property
     def note_offs(self):
-        return map(lambda note: mido.Message('note_off', note=note, velocity=0), self.playing_notes)
+        return [event.Event.make(note_off, note=note, velocity=0) for note in self.playing_notes]
 
 
 note_off = "note_off"
 note_on = "note_on"
 
+NOTE_TYPES = (note_on, note_off)
+
+
+class ChannelParameters(object):
+    """
+    A snapshot of the parameters that effects change on a channel. Snapshots are never modified; a new one is
+    published for every change so that the audio thread can read all parameters at once without taking a lock.
+    """
+
+    __slots__ = ("version", "volume", "gain", "fade_start", "intervals")
+
+    def __init__(self, version=0, volume=VOLUME_DEFAULT, gain=1., fade_start=None, intervals=None):
+        """
+
+        :param version: Incremented every time a new snapshot is published
+        :param volume: The volume of the channel (0.0 - 1.0)
+        :param gain: The gain of the track the channel belongs to (0.0 - 1.0), which scales the channel volume
+        controller so that notes that are already sounding follow it too
+        :param fade_start: The time at which a fade out started or None
+        :param intervals: The Intervals applied to notes played on the channel or None
+        """
+        self.version = version
+        self.volume = volume
+        self.gain = gain
+        self.fade_start = fade_start
+        self.intervals = intervals
+
+    def replace(self, **changes):
+        """
+        :param changes: New values for one or more parameters
+        :return: A new snapshot with the next version number
+        """
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(changes)
+        values["version"] = self.version + 1
+        return ChannelParameters(**values)
+
+
+def scale_velocity_stage(volume, msgs):
+    """Scale the velocity of note messages by a volume"""
+    return [msg.replace(velocity=int(volume * msg.velocity)) if msg.type in NOTE_TYPES else msg for msg in msgs]
+
+
+def key_tracking_stage(tracker, msgs):
+    """Pass notes to a KeyTracker"""
+    for msg in msgs:
+        if msg.type in NOTE_TYPES:
+            tracker.add_note(msg.note)
+    return msgs
+
+
+def intervals_stage(intervals, msgs):
+    """Turn each note into a set of intervals"""
+    new_msgs = []
+    for msg in msgs:
+        if msg.type in NOTE_TYPES:
+            new_msgs.extend(intervals(msg))
+        else:
+            new_msgs.append(msg)
+    return new_msgs
+
+
+def listening_stage(queue, msgs):
+    """Pass a copy of each note_on to a listening Queue"""
+    for msg in msgs:
+        if msg.type == note_on:
+            queue.put(msg)
+    return msgs
+
+
+def percussive_stage(msgs):
+    """Redirect messages to the percussion channel"""
+    return [msg.replace(channel=PERCUSSION_CHANNEL) for msg in msgs]
+
 
 class Channel(object):
     """Represents an individual midi channel through which messages are passed"""
 
-    def __init__(self, number, volume=VOLUME_DEFAULT, fade_rate=1, note_on_listener=None):
+    def __init__(self, number, volume=VOLUME_DEFAULT, fade_rate=1, note_on_listener=None, is_active=True,
+                 clock=clock.wall_clock, timers=timers.shared_timers, instrument_type_listener=None):
         """
 
         :param number: The number of this channel (0-15)
         :param volume: The initial volume of this channel (0.0 - 1.0)
         :param fade_rate: The rate at which this channel should fade
         :param note_on_listener: A listener that is called every time a note_on is played by this channel
+        :param is_active: If False program changes are held back until activate is called so that a channel can be
+        prepared without disturbing whatever is currently playing
+        :param clock: The clock that fades are timed with (see clock)
+        :param timers: The timers that continuous parameters are updated from (see automation)
+        :param instrument_type_listener: A listener that is called with this channel, the old instrument type and the
+        new instrument type every time a program change moves the channel to a different type of instrument
         """
+        self.is_active = is_active
+        self.clock = clock
+        # The output lane for messages played through this channel (see ports). Control changes read from the file
+        # share it with the notes and programs around them so that they are never reordered (e.g. a bank select
+        # behind the program change it is for). Only automation goes in the control lane.
+        self.lane = ports.NOTES
         self.note_on_listener = note_on_listener
-        self.listening_queue = None
+        self.instrument_type_listener = instrument_type_listener
+        self.__listening_queue = None
         self.number = number
         # Decides which port output should be used depending on the channel number
         # self.port = keys_port if number < CHANNEL_PARTITION else drum_port
         self.port = keys_port
-        self.__volume = volume
-        self.__volume_queue = Queue()
         self.fade_rate = fade_rate
-        self.__fade_start = None
-        self.__fade_start_queue = Queue()
+        self.__parameters = ChannelParameters(volume=volume)
+        # Only taken by threads publishing changes. The audio thread just reads the current snapshot.
+        self.__parameters_lock = Lock()
+        # The intervals that the audio thread is currently applying
+        self.__applied_intervals = None
         self.playing_notes = set()
-        self.__intervals = None
-        self.__intervals_queue = Queue()
+        # Set once anything has been played through this channel
+        self.is_used = False
         self.__program = 0
-        self.__modulation = 0
-        self.__pan = 63
-        self.key_tracker = None
+        # The channel volume set by the file and the value last sent to the synth, which is scaled by the gain. The
+        # value on the synth is not known until one has been sent as another track may have left it anywhere.
+        self.__controller_volume = CONTROLLER_VOLUME_DEFAULT
+        self.__sent_controller_volume = None
+        # Pitch bend, modulation, pan and volume are sent at a limited rate and only when they change
+        self.automation = automation.Automation(timers, config.AUTOMATION_MAX_RATE)
+        self.automation.add("pitch", pitchwheel, self.send_pitch, PITCHWHEEL_DEFAULT)
+        self.automation.add("modulation", automation.byte, partial(self.send_control, 1), 0)
+        self.automation.add("pan", automation.byte, partial(self.send_control, 10), 63)
+        self.automation.add("volume", quantize_volume, self.publish_volume, read=lambda: self.volume)
+        # Bounds the notes sounding on this channel or None
+        self.voices = None
+        if config.VOICES_POLYPHONY > 0 or config.VOICES_MAX_DURATION > 0:
+            self.voices = voices.VoiceAllocator(timers, self.stop_voice, config.VOICES_POLYPHONY,
+                                                config.VOICES_STEALING, config.VOICES_MAX_DURATION)
+        self.__key_tracker = None
         self.note_set = set()
+        # The stages that messages currently pass through and the parameters they were built for
+        self.__chain = []
+        self.__chain_parameters = None
+
+    def invalidate_chain(self):
+        """Force the processing chain to be rebuilt before the next message is sent"""
+        self.__chain_parameters = None
+
+    @property
+    def key_tracker(self):
+        """A KeyTracker that is updated with every note played on this channel or None"""
+        return self.__key_tracker
+
+    @key_tracker.setter
+    def key_tracker(self, key_tracker):
+        self.__key_tracker = key_tracker
+        self.invalidate_chain()
+
+    @property
+    def listening_queue(self):
+        """A Queue that is passed every note_on played on this channel or None"""
+        return self.__listening_queue
+
+    @listening_queue.setter
+    def listening_queue(self, listening_queue):
+        self.__listening_queue = listening_queue
+        self.invalidate_chain()
+
+    @property
+    def parameters(self):
+        """The most recently published ChannelParameters"""
+        return self.__parameters
+
+    def publish(self, **changes):
+        """
+        Publish a new snapshot of parameters to be picked up by the audio thread
+        :param changes: New values for one or more parameters (see ChannelParameters)
+        """
+        with self.__parameters_lock:
+            self.__parameters = self.__parameters.replace(**changes)
 
     @property
     def volume(self):
-        while not self.__volume_queue.empty():
-            self.__volume = self.__volume_queue.get()
-        return self.__volume
+        return self.__parameters.volume
 
     @volume.setter
     def volume(self, volume):
-        self.fade_start = None
-        self.__volume_queue.put(volume)
+        self.publish(volume=volume, fade_start=None)
+
+    @property
+    def gain(self):
+        """The gain of the track this channel belongs to (see mixer)"""
+        return self.__parameters.gain
+
+    @gain.setter
+    def gain(self, gain):
+        self.publish(gain=gain)
+        if self.playing_notes:
+            # Otherwise the volume is sent ahead of the next message
+            self.send_volume_control(gain)
+
+    def take_volume_control(self, gain):
+        """
+        :param gain: A gain
+        :return: A control change that sets the channel volume to the volume from the file scaled by the gain or None
+        if the volume is already set. The control change is taken to have been sent.
+        """
+        value = automation.byte(self.__controller_volume * gain)
+        if value == self.__sent_controller_volume:
+            return None
+        self.__sent_controller_volume = value
+        return event.Event.make("control_change", channel=self.number, control=VOLUME_CONTROL, value=value)
+
+    def send_volume_control(self, gain):
+        """
+        Set the channel volume to the volume from the file scaled by a gain if it is not set already
+        :param gain: A gain, e.g. 1 to take the volume back to that of the file once a faded track has stopped
+        """
+        volume_control = self.take_volume_control(gain)
+        if volume_control is not None:
+            self.port.send(volume_control.replace(channel=self.output_numbers[-1]), self.lane)
+
+    def reset_volume_control(self):
+        """Set the channel volume back to the default once the track has stopped, if this channel ever set it"""
+        self.__controller_volume = CONTROLLER_VOLUME_DEFAULT
+        if self.__sent_controller_volume is not None:
+            self.send_volume_control(1.)
+
+    def publish_volume(self, volume):
+        self.volume = volume
+
+    def ramp(self, name, value, seconds=0.):
+        """
+        Move a continuous parameter to a new value (see automation)
+        :param name: pitch, modulation, pan or volume
+        :param value: The value to move to
+        :param seconds: How long the move should take
+        """
+        self.automation.set(name, value, seconds)
 
     @property
     def modulation(self):
-        return self.__modulation
+        return self.automation.value("modulation")
 
     @modulation.setter
     def modulation(self, modulation):
-        self.__modulation = modulation
-        self.port.send(mido.Message('control_change', channel=self.number, control=1, value=self.__modulation))
+        self.ramp("modulation", modulation)
 
     @property
     def pan(self):
-        return self.__pan
+        return self.automation.value("pan")
 
     @pan.setter
     def pan(self, pan):
-        self.__pan = pan
-        self.port.send(mido.Message('control_change', channel=self.number, control=10, value=self.__modulation))
+        self.ramp("pan", pan)
+
+    def send_control(self, control, value):
+        self.port.send(event.Event.make("control_change", channel=self.number, control=control, value=value),
+                       ports.CONTROL)
+
+    def send_pitch(self, pitch):
+        self.port.send(event.Event.make("pitchwheel", channel=self.number, pitch=pitch), ports.CONTROL)
 
     @property
     def fade_start(self):
-        while not self.__fade_start_queue.empty():
-            if self.__fade_start is None:
-                self.__fade_start = datetime.now()
-        return self.__fade_start
+        return self.__parameters.fade_start
 
     @fade_start.setter
     def fade_start(self, fade_start):
-        self.__fade_start = fade_start
+        self.publish(fade_start=fade_start)
 
     def fade(self):
-        self.__fade_start_queue.put("start")
+        if self.fade_start is None:
+            self.fade_start = self.clock.now()
 
     @property
     def intervals(self):
         """The set of intervals currently applied to notes played on this channel"""
-        while not self.__intervals_queue.empty():
-            if self.__intervals is not None:
-                for note_off in self.__intervals.note_offs:
-                    note_off.channel = self.number
-                    self.port.send(note_off)
-            self.__intervals = self.__intervals_queue.get()
-        return self.__intervals
+        return self.__parameters.intervals
 
     @intervals.setter
     def intervals(self, intervals):
         if isinstance(intervals, list):
             intervals = Intervals(intervals)
-        self.__intervals_queue.put(intervals)
+        self.publish(intervals=intervals)
+
+    def apply_intervals(self, intervals):
+        """
+        Switch the intervals applied by the audio thread, stopping any notes held by the previous intervals
+        :param intervals: The new Intervals or None
+        """
+        if self.__applied_intervals is not None:
+            note_offs = [note_off.replace(channel=self.number) for note_off in self.__applied_intervals.note_offs]
+            if self.voices is not None:
+                # Leaves out notes the allocator has already stopped
+                note_offs = self.voices(note_offs)
+            for note_off in note_offs:
+                self.port.send(note_off, self.lane)
+        self.__applied_intervals = intervals
 
     @property
     def program(self):
@@ -317,8 +592,18 @@ class Channel(object):
 
     @program.setter
     def program(self, program):
+        old_instrument_type = self.instrument_type
         self.__program = program
-        self.port.send(mido.Message('program_change', program=self.__program, time=0, channel=self.number))
+        self.invalidate_chain()
+        if self.instrument_type_listener is not None and self.instrument_type != old_instrument_type:
+            self.instrument_type_listener(self, old_instrument_type, self.instrument_type)
+        if self.is_active:
+            self.port.send(mido.Message('program_change', program=self.__program, time=0, channel=self.number))
+
+    def activate(self):
+        """Start sending program changes, sending the current program"""
+        self.is_active = True
+        self.program = self.__program
 
     @property
     def instrument_type(self):
@@ -342,62 +627,107 @@ class Channel(object):
         if 0 <= instrument_version < 8:
             self.program = 8 * self.instrument_type + instrument_version
 
-    def pitch_bend(self, value):
+    def pitch_bend(self, value, seconds=0.):
         """
-        Send a pitch bend to this channel
-        :param value: The value of the pitch bend
+        Bend the pitch of this channel
+        :param value: The pitchwheel value to bend to
+        :param seconds: How long the bend should take
         """
-        self.port.send(mido.Message('pitchwheel', pitch=value, time=0, channel=self.number))
+        self.ramp("pitch", value, seconds)
 
-    def send_message(self, msg):
+    def build_chain(self, parameters):
+        """
+        Make the list of stages that messages pass through, leaving out any that would have no effect
+        :param parameters: The ChannelParameters the chain is built for
+        :return: A list of functions that each take and return a list of messages
+        """
+        chain = []
+        if parameters.fade_start is not None:
+            chain.append(partial(self.fade_stage, parameters))
+        elif parameters.volume != VOLUME_DEFAULT:
+            chain.append(partial(scale_velocity_stage, parameters.volume))
+        if self.__key_tracker is not None:
+            chain.append(partial(key_tracking_stage, self.__key_tracker))
+        if parameters.intervals is not None:
+            chain.append(partial(intervals_stage, parameters.intervals))
+        if self.__listening_queue is not None:
+            chain.append(partial(listening_stage, self.__listening_queue))
+        if self.is_percussive:
+            chain.append(percussive_stage)
+        if self.voices is not None:
+            chain.append(self.voices)
+        return chain
+
+    def fade_stage(self, parameters, msgs):
+        """Scale velocities by the volume of a fade out in progress"""
+        # How long has the fade been occurring?
+        seconds = self.clock.now() - parameters.fade_start
+        volume = parameters.volume * (1 - self.fade_rate * seconds)
+        if volume < 0:
+            volume = 0
+            self.volume = 0
+        return scale_velocity_stage(volume, msgs)
+
+    def send_message(self, msg, lane=None):
         """
         Apply effects and dispatch a midi message
-        :param msg: a midi message
+        :param msg: an event.Event
+        :param lane: The output lane to send in, overriding the lane of this channel (see ports)
         """
 
         try:
-            # True if a fade out is in progress
-            if self.fade_start is not None:
-                # How long has the fade been occurring?
-                seconds = (datetime.now() - self.fade_start).total_seconds()
-                self.volume *= (1 - self.fade_rate * seconds)
-                if self.volume < 0:
-                    self.volume = 0
-                    self.fade_start = None
-
-            if hasattr(msg, 'velocity'):
-                msg.velocity = int(self.volume * msg.velocity)
-
-            if self.key_tracker and hasattr(msg, "note"):
-                # Update the key tracker
-                self.key_tracker.add_note(msg.note)
-
-            if hasattr(msg, 'velocity') and self.intervals is not None:
-                msgs = self.intervals(msg)
+            # Read every parameter from a single snapshot and rebuild the chain only if something has changed
+            parameters = self.__parameters
+            if parameters is not self.__chain_parameters:
+                if parameters.intervals is not self.__applied_intervals:
+                    self.apply_intervals(parameters.intervals)
+                self.__chain = self.build_chain(parameters)
+                self.__chain_parameters = parameters
+
+            self.is_used = True
+            lane = lane or self.lane
+            msgs = [msg]
+            if msg.type == "control_change" and msg.control == VOLUME_CONTROL:
+                # Sent below scaled by the gain
+                self.__controller_volume = msg.value
+                msgs = []
+            volume_control = self.take_volume_control(parameters.gain)
+            if volume_control is not None:
+                msgs.insert(0, volume_control)
+            if self.__chain:
+                for stage in self.__chain:
+                    msgs = stage(msgs)
+                for output_msg in msgs:
+                    # Actually send the midi message
+                    self.port.send(output_msg, lane)
             else:
-                msgs = [msg]
-
-            for msg in msgs:
-                if self.listening_queue is not None and msg.type == "note_on":
-                    self.listening_queue.put(msg)
-                if self.is_percussive:
-                    msg.channel = 10
-                # Actually send the midi message
-                self.port.send(msg)
-            if hasattr(msg, 'type'):
-                # Check if it was a note message
-                if msg.type == note_on:
-                    # Keep track of notes that are currently playing
-                    self.playing_notes.add(msg.note)
-                    if self.note_on_listener is not None:
-                        self.note_on_listener(msg)
-                elif msg.type == note_off and msg.note in self.playing_notes:
-                    self.playing_notes.remove(msg.note)
+                # Nothing is active so pass the messages straight through
+                for output_msg in msgs:
+                    self.port.send(output_msg, lane)
+            # Check if it was a note message
+            if msg.type == note_on:
+                # Keep track of notes that are currently playing
+                self.playing_notes.add(msg.note)
+                if self.note_on_listener is not None:
+                    self.note_on_listener(msg)
+            elif msg.type == note_off and msg.note in self.playing_notes:
+                self.playing_notes.remove(msg.note)
         except AttributeError as e:
             logging.exception(e)
         except ValueError as e:
             logging.exception(e)
 
+    def stop_voice(self, msg):
+        """
+        Send the note_off for a note that the voice allocator has stopped
+        :param msg: A note_off event
+        """
+        self.playing_notes.discard(msg.note)
+        intervals = self.__parameters.intervals
+        if intervals is not None:
+            intervals.playing_notes.discard(msg.note)
+        self.port.send(msg, self.lane)
+
     def stop_playing_notes(self):
         """Stop all currently playing notes"""
         for note in self.playing_notes.copy():
@@ -409,38 +739,133 @@ class Channel(object):
         :param note: The midi position of the note
         """
         # noinspection PyTypeChecker
-        self.send_message(mido.Message(type=note_off, velocity=0, note=note))
+        self.send_message(event.Event.make(note_off, channel=self.number, note=note, velocity=0))
+
+    @property
+    def output_numbers(self):
+        """The numbers of the channels that messages played through this channel are sent on"""
+        if self.is_percussive:
+            return [self.number, PERCUSSION_CHANNEL]
+        return [self.number]
 
     def stop_all_notes(self):
-        for i in range(128):
-            self.port.send(mido.Message(type=note_off, velocity=0, channel=self.number, note=i))
+        if self.voices is not None:
+            self.voices.clear()
+        self.port.stop_notes(self.output_numbers)
 
     @property
     def is_percussive(self):
         return self.instrument_type == InstrumentType.percussive
 
 
+class ChannelView(object):
+    """
+    The channels of a track with some channel numbers or types of instrument. The view follows program changes so
+    it always holds the channels that currently match, and is only worked out again when the programs of the track
+    have changed.
+    """
+
+    def __init__(self, track, numbers=(), instrument_types=()):
+        """
+
+        :param track: A Track
+        :param numbers: Channel numbers
+        :param instrument_types: The string names or integer numbers of instrument types (see InstrumentType)
+        """
+        self.track = track
+        self.numbers = frozenset(numbers)
+        self.instrument_types = frozenset(InstrumentType.with_name(instrument_type)
+                                          if isinstance(instrument_type, basestring) else instrument_type
+                                          for instrument_type in instrument_types)
+        self.__version = None
+        self.__channels = ()
+
+    @property
+    def channels(self):
+        """A tuple of the channels that currently match in channel number order"""
+        version = self.track.index_version
+        if version != self.__version:
+            channels = {channel for channel in self.track.channels if channel.number in self.numbers}
+            for instrument_type in self.instrument_types:
+                channels.update(self.track.channels_with_instrument_type(instrument_type))
+            self.__channels = tuple(sorted(channels, key=lambda channel: channel.number))
+            self.__version = version
+        return self.__channels
+
+    def __iter__(self):
+        return iter(self.channels)
+
+    def __len__(self):
+        return len(self.channels)
+
+    def __getitem__(self, index):
+        return self.channels[index]
+
+
 class Track(Thread):
     """Represents a midi song loaded from a file"""
 
     def __init__(self, file_path="../media/channels_test.mid", is_looping=False, play_notes=True,
-                 message_read_listener=lambda x: x):
+                 message_read_listener=lambda x: x, clock=clock.wall_clock, mixer=None, priority=0):
+        """
+
+        :param file_path: The path to a midi file
+        :param is_looping: Should the track play again when it reaches the end?
+        :param play_notes: If False note_ons are read but not played
+        :param message_read_listener: Called with every message read from the file
+        :param clock: The clock that playback is timed with. A clock.VirtualClock plays faster than real time.
+        :param mixer: The Mixer that plays this track. Defaults to the shared mixer when playing in real time and to
+        a thread of its own otherwise.
+        :param priority: Events from tracks with a higher priority are played first when several are due at once
+        """
         super(Track, self).__init__()
+        self.clock = clock
         self.filename = file_path
         self.play_notes = play_notes
         self.is_stopping = False
         self.is_looping = is_looping
-        self.mid = mido.MidiFile(file_path)
-        self.original_tempo = self.mid.ticks_per_beat
-        self.channels = map(Channel, range(0, 16))
-        for track in self.mid.tracks:
-            msg = track[0]
-            if msg.type == "program_change":
-                self.channels[msg.channel].instrument_type = msg.program
+        # Set when another track has been told to hand off to this one
+        self.previous_track = None
+        self.next_track = None
+        self.hand_off_position = None
+        self.__is_started = False
+        self.__is_playing = False
+        self.__start_lock = Lock()
+        self.clears_notes_on_start = True
+        self.clears_notes_on_stop = True
+        if mixer is None and clock is shared_mixer.clock:
+            mixer = shared_mixer
+        self.mixer = mixer
+        # Runs anything that has to happen at a given time while the track plays, e.g. removing effects
+        self.timers = timers.shared_timers if clock is timers.shared_timers.clock else timers.Timers(clock)
+        self.priority = priority
+        self.__gain = 1.
+        # The index of the next event in the timeline
+        self.__index = 0
+        # The position to move playback to before the next step or None (see seek)
+        self.__seek_position = None
+        self.timeline = timeline_cache.load(file_path)
+        self.__file_channels = frozenset(self.timeline.channels)
+        # (start index, start position, end index, end position) of the section that repeats (see set_loop)
+        self.__loop = None
+        # Set when the next pass of the loop has been lined up but the notes still sounding at the end of the last
+        # pass have not been stopped
+        self.__is_wrapping = False
+        self.set_loop(*config.LOOPS.get(os.path.basename(file_path).lower(), (0, None)))
+        # Channels stay inactive until the track starts so that a track can be prepared while another is playing
+        self.channels = [Channel(number, is_active=False, clock=clock, timers=self.timers,
+                                 instrument_type_listener=self.instrument_type_changed) for number in range(0, 16)]
+        # The channels playing each type of instrument, kept up to date as programs change
+        self.__channels_by_type = [()] * 16
+        self.__channels_by_type[InstrumentType.piano] = tuple(self.channels)
+        self.__index_lock = Lock()
+        # Counts changes to the index so that views of it know when to look again (see ChannelView)
+        self.index_version = 0
+        for channel, program in zip(self.timeline.program_channels, self.timeline.programs):
+            self.channels[channel].instrument_type = program
         for channel in self.channels_with_instrument_group("melodic"):
             channel.key_tracker = key_tracker
-        self.__tempo_shift = TEMPO_SHIFT_DEFAULT
-        self.__tempo_shift_queue = Queue()
+        self.scheduler = scheduler.Scheduler(TEMPO_SHIFT_DEFAULT, clock=clock)
         self.message_read_listener = message_read_listener
         self.channel_mappers = [
             ChannelMapper("drums", self),
@@ -448,26 +873,85 @@ class Track(Thread):
             ChannelMapper("keys", self),
             ChannelMapper("bass", self),
         ]
+        # (note_on routes, routes) giving the output channel for each input channel or None to drop (see route)
+        self.__routing = None
+        self.__current_channels = None
+        self.update_routing()
+        # Also a channel of the file, so sound effects are put in the effects lane where they are played
         self.sound_effects_channel = self.channels[config.SOUND_EFFECTS_CHANNEL]
         self.sound_effects_channel.instrument_type = InstrumentType.synth_effects
         self.sound_effects_channel.instrument_version = 2
 
     @property
     def current_channels(self):
-        return [mapper.current_channel for mapper in self.channel_mappers]
+        return self.__current_channels
+
+    def update_routing(self):
+        """
+        Recompute the routing tables from the channel mappers. Called whenever the mode of a mapper changes.
+        """
+        note_on_routes = [None] * 16
+        routes = [None] * 16
+        for mapper in self.channel_mappers:
+            for channel in mapper.input_channels:
+                if routes[channel] is None:
+                    routes[channel] = mapper.output_channel
+            if note_on_routes[mapper.current_channel] is None:
+                note_on_routes[mapper.current_channel] = mapper.output_channel
+        self.__current_channels = [mapper.current_channel for mapper in self.channel_mappers]
+        self.__routing = (note_on_routes, routes)
+
+    def route(self, msg):
+        """
+        Send a message read from the file through the channel mapper for its channel. Note_ons are only played from
+        the current channel of each mapper whereas other messages pass from every input channel. Everything else is
+        dropped.
+        :param msg: An event.Event
+        :return: The event as it was sent on its output channel or None if it was dropped
+        """
+        note_on_routes, routes = self.__routing
+        output_channel = (note_on_routes if msg.type == note_on else routes)[msg.channel]
+        if output_channel is None:
+            return None
+        msg = msg.replace(channel=output_channel)
+        self.send_message(msg)
+        return msg
 
     @property
     def output_channels(self):
         return [mapper.output_channel for mapper in self.channel_mappers]
 
+    @property
+    def channel_numbers(self):
+        """The numbers of the channels this track plays on: those used by its file and any it has played through since
+        it began (e.g. when routed by its channel mappers)"""
+        return {number for channel in self.channels if channel.number in self.__file_channels or channel.is_used
+                for number in channel.output_numbers}
+
     @property
     def tempo_shift(self):
-        return self.__tempo_shift
+        return self.scheduler.tempo_shift
 
     @tempo_shift.setter
     def tempo_shift(self, tempo_shift):
-        self.mid.ticks_per_beat = tempo_shift * self.original_tempo
-        self.__tempo_shift = tempo_shift
+        self.scheduler.tempo_shift = tempo_shift
+
+    @property
+    def position(self):
+        """How far playback has got through the file in seconds, e.g. for another track to seek to"""
+        return self.scheduler.position
+
+    def instrument_type_changed(self, channel, old_instrument_type, new_instrument_type):
+        """
+        Move a channel between entries of the instrument type index. Entries are replaced rather than changed so that
+        other threads can read them without a lock.
+        """
+        with self.__index_lock:
+            self.__channels_by_type[old_instrument_type] = tuple(
+                c for c in self.__channels_by_type[old_instrument_type] if c is not channel)
+            self.__channels_by_type[new_instrument_type] = tuple(
+                sorted(self.__channels_by_type[new_instrument_type] + (channel,), key=lambda c: c.number))
+            self.index_version += 1
 
     def channels_with_instrument_type(self, instrument_type):
         """
@@ -475,9 +959,9 @@ class Track(Thread):
         :param instrument_type: The string name or integer number of the instrument type (see InstrumentType)
         :return: A list of channels
         """
-        if isinstance(instrument_type, str):
+        if isinstance(instrument_type, basestring):
             instrument_type = InstrumentType.with_name(instrument_type)
-        return filter(lambda c: c.instrument_type == instrument_type, self.channels)
+        return list(self.__channels_by_type[instrument_type])
 
     def channels_with_instrument_group(self, instrument_group):
         """
@@ -487,48 +971,605 @@ class Track(Thread):
             """
         channels = []
         for instrument_type in InstrumentGroup.with_name(instrument_group):
-            channels.extend(self.channels_with_instrument_type(instrument_type))
+            channels.extend(self.__channels_by_type[instrument_type])
         return channels
 
     def send_message(self, msg):
         self.channels[msg.channel].send_message(msg)
 
+    def next_bar(self, position):
+        """
+        :param position: A position in the song in seconds
+        :return: The position of the first bar boundary at or after that position
+        """
+        bar_length = self.timeline.bar_length
+        return math.ceil(position / bar_length) * bar_length
+
+    def start(self):
+        """
+        Start playing in the mixer of this track, or on a new thread if it has no mixer. Does nothing if the track
+        has already started or is waiting for another track to hand off to it.
+        """
+        with self.__start_lock:
+            if self.__is_started or self.previous_track is not None:
+                return
+            self.__is_started = True
+            self.__is_playing = True
+        if self.mixer is not None:
+            self.mixer.add(self)
+        else:
+            self.clock.register(self)
+            super(Track, self).start()
+
+    @property
+    def is_playing(self):
+        """True from the time the track is started until it finishes"""
+        return self.__is_playing
+
+    @property
+    def gain(self):
+        """The gain applied to every channel of this track (0.0 - 1.0)"""
+        return self.__gain
+
+    @gain.setter
+    def gain(self, gain):
+        self.__gain = gain
+        for channel in self.channels:
+            channel.gain = gain
+
+    def set_loop(self, start_tick=0, end_tick=None):
+        """
+        Choose the section of the file that repeats when the track is looping. Playback always starts from the
+        beginning of the file so anything before the section plays once as an intro.
+        :param start_tick: The start of the section in ticks
+        :param end_tick: The end of the section in ticks or None for the end of the file
+        """
+        start_index = self.timeline.index_at_tick(start_tick)
+        start_position = self.timeline.seconds_at_tick(start_tick)
+        if end_tick is None:
+            end_index = len(self.timeline)
+            end_position = self.timeline.length
+        else:
+            end_index = self.timeline.index_at_tick(end_tick)
+            end_position = self.timeline.seconds_at_tick(end_tick)
+        if end_tick is not None and end_position <= start_position:
+            raise AssertionError("Loop from tick {} to tick {} is empty".format(start_tick, end_tick))
+        self.__loop = (start_index, start_position, end_index, end_position)
+
+    def seek(self, seconds=None, ticks=None):
+        """
+        Move playback to a point in the file. The programs, controllers and pitch bends set before that point are sent
+        again so that the channels sound as if the track had played up to it. Takes effect before the next step of
+        the thread playing the track, or as soon as it starts if it has not started yet.
+        :param seconds: The point in seconds from the start of the file
+        :param ticks: The point in ticks from the start of the file, following any tempo changes
+        """
+        if ticks is not None:
+            seconds = self.timeline.seconds_at_tick(ticks)
+        elif seconds is None:
+            raise AssertionError("Seek needs a time in seconds or ticks")
+        start_index, start_position, end_index, end_position = self.__loop
+        if self.is_looping and seconds >= end_position:
+            # Land where the loop would have got to
+            seconds = start_position + (seconds - start_position) % (end_position - start_position)
+        self.__seek_position = min(max(seconds, 0.), self.timeline.length)
+
+    def __apply_seek(self):
+        """Move to the position given to seek. Called on the thread that plays the track."""
+        position, self.__seek_position = self.__seek_position, None
+        self.__is_wrapping = False
+        for channel in self.channels:
+            channel.stop_playing_notes()
+        self.__index = self.timeline.index_at_time(position)
+        self.scheduler.start(position)
+        for msg in self.timeline.chase(self.__index):
+            # Passed on as advance does so that a listener that routes the track (e.g. the game) sees them too
+            self.message_read_listener(msg)
+            self.channels[msg.channel].send_message(msg)
+
+    def __wrap(self):
+        """Move to the start of the loop, continuing from exactly where the end of the loop falls"""
+        start_index, start_position, end_index, end_position = self.__loop
+        self.scheduler.rewind(end_position - start_position)
+        self.__index = start_index
+        self.__is_wrapping = True
+
+    def hand_off(self, next_track):
+        """
+        Stop playing at the next bar boundary and start another track at the same moment. If this track is not
+        playing the other track starts straight away. If this track is itself waiting for a hand off the other track
+        takes its place, so that the track that is playing hands off to the other track instead.
+        :param next_track: A Track that has not been started
+        """
+        with hand_off_lock:
+            previous_track = self.previous_track
+            if previous_track is not None:
+                self.previous_track = None
+                next_track.previous_track = previous_track
+                previous_track.next_track = next_track
+                return
+            next_track.previous_track = self
+            if not self.is_playing:
+                self.__start_next_track(next_track)
+                return
+            end_position = self.__loop[3] if self.is_looping else self.timeline.length
+            self.hand_off_position = min(self.next_bar(self.scheduler.position), end_position)
+            self.next_track = next_track
+
+    def __start_next_track(self, next_track):
+        next_track.previous_track = None
+        # Nothing needs clearing as this track has stopped its own notes
+        next_track.clears_notes_on_start = False
+        next_track.start()
+
+    def begin(self):
+        """
+        Get ready to play from the start of the file. Called on the thread that plays the track. A stop requested
+        before the track began still holds so the track finishes at its first step.
+        """
+        # Also set here for a track that is played by calling run
+        self.__is_playing = True
+        if self.clears_notes_on_start:
+            self.stop_all_notes()
+        for channel in self.channels:
+            channel.activate()
+        self.__index = 0
+        self.__is_wrapping = False
+        self.scheduler.start()
+
+    def next_position(self):
+        """
+        :return: The position in the song at which the next step is due or None if it is due straight away
+        """
+        if self.is_stopping or self.__seek_position is not None:
+            return None
+        start_position, end_index, end_position = self.__loop[1:]
+        if self.__is_wrapping:
+            # The end of the last pass, which is where the loop starts now that it has been rewound
+            position = start_position
+        elif self.is_looping and self.__index >= end_index:
+            # Wait out the rest of the loop before the next pass
+            position = end_position
+        elif self.__index < len(self.timeline):
+            position = self.timeline.times[self.__index]
+        else:
+            return None
+        if self.next_track is not None:
+            position = min(position, self.hand_off_position)
+        return position
+
+    def advance(self):
+        """
+        Wait for the next step and take it: play the next event from the timeline or start the next pass of a loop.
+        The loop is treated as a ring so the next pass is lined up as soon as the last event of a pass has played.
+        :return: False if the track has finished
+        """
+        if self.__seek_position is not None and not self.is_stopping:
+            self.__apply_seek()
+            return True
+        position = self.next_position()
+        if position is None:
+            return False
+        self.scheduler.wait_until(position)
+        if self.next_track is not None and position >= self.hand_off_position:
+            return False
+
+        if self.__is_wrapping:
+            # Notes whose note_off falls after the end of the loop would otherwise sound forever
+            self.__is_wrapping = False
+            for channel in self.channels:
+                channel.stop_playing_notes()
+            return True
+
+        start_index, start_position, end_index, end_position = self.__loop
+        if self.is_looping and self.__index >= end_index:
+            self.__wrap()
+            return True
+
+        index = self.__index
+        self.__index += 1
+
+        if instrumentation.recorder.enabled:
+            instrumentation.recorder.record_dispatch(self.timeline.channels[index],
+                                                     self.scheduler.deadline(self.timeline.times[index]),
+                                                     self.clock.now())
+
+        try:
+            msg = self.timeline.event(index)
+            self.message_read_listener(msg)
+            if self.is_stopping:
+                return False
+
+            try:
+                # Send a message to its assigned channel
+                if self.play_notes or msg.type != note_on:
+                    self.channels[msg.channel].send_message(msg)
+            except AttributeError as e:
+                logging.exception(e)
+            except IndexError as e:
+                logging.exception(e)
+        finally:
+            if instrumentation.recorder.enabled:
+                # Anything sent afterwards on this thread (e.g. the gain of a fade) was not scheduled with the message
+                instrumentation.recorder.end_dispatch()
+
+        if self.is_looping and self.__index == end_index and start_index < end_index and self.next_track is None:
+            self.__wrap()
+        return True
+
+    def finish(self):
+        """Stop the notes this track started and start the track it is handing off to"""
+        self.__is_playing = False
+        for channel in self.channels:
+            # Removing an effect may have left pitch bend, modulation or pan part way back to its default
+            channel.automation.reset()
+        with hand_off_lock:
+            if self.next_track is not None and self.next_track.is_stopping:
+                # The hand off was cancelled by a stop
+                self.next_track.previous_track = None
+                self.next_track = None
+            if self.next_track is not None:
+                # Only stop the notes this track is playing so that the next track can start without a gap
+                for channel in self.channels:
+                    channel.stop_playing_notes()
+                self.__start_next_track(self.next_track)
+            elif self.clears_notes_on_stop:
+                self.stop_all_notes()
+            else:
+                for channel in self.channels:
+                    channel.stop_playing_notes()
+        for channel in self.channels:
+            # Take back any channel volume that the file or a fade changed
+            channel.reset_volume_control()
+
     def run(self):
-        """Play the midi file (call start() to run on new thread)"""
-        self.is_stopping = False
-        self.stop_all_notes()
-        play = self.mid.play(meta_messages=True)
-
-        while True:
-
-            # Take midi messages from a generator
-            for msg in play:
-                self.message_read_listener(msg)
-                if self.is_stopping:
-                    break
-
-                try:
-                    if isinstance(msg, mido.MetaMessage):
-                        continue
-                    # Send a message to its assigned channel
-                    if self.play_notes or msg.type != note_on:
-                        self.channels[msg.channel].send_message(msg)
-                except AttributeError as e:
-                    logging.exception(e)
-                except IndexError as e:
-                    logging.exception(e)
-
-            if self.is_looping and not self.is_stopping:
-                play = self.mid.play(meta_messages=True)
-                continue
-            break
-        self.stop_all_notes()
+        """Play the midi file on this thread (call start() to play in the mixer or on a new thread)"""
+        thread = current_thread()
+        self.clock.register(thread)
+        try:
+            self.begin()
+            while self.advance():
+                pass
+            self.finish()
+        finally:
+            self.clock.unregister(thread)
 
     def stop_all_notes(self):
+        """Stop all notes on every channel with one request to each port"""
+        channels_by_port = {}
         for channel in self.channels:
-            channel.stop_all_notes()
+            if channel.voices is not None:
+                channel.voices.clear()
+            channels_by_port.setdefault(channel.port, set()).update(channel.output_numbers)
+        for port, numbers in channels_by_port.items():
+            port.stop_notes(numbers)
 
     # noinspection PyUnusedLocal
     def stop(self, *args):
-        """Stops the song by breaking the loop"""
+        """
+        Stops the song by breaking the loop. A pending hand off is cancelled: stopping either track stops the other
+        so that the outgoing track does not play on to the bar and the incoming track never starts.
+        """
+        if self.is_stopping:
+            return
         self.is_stopping = True
+        for track in (self.previous_track, self.next_track):
+            if track is not None:
+                track.stop()
+
+
+class PlaybackTestCase(unittest.TestCase):
+    """Plays through a RecordingPort with a free running virtual clock so that no midi device is needed"""
+
+    def setUp(self):
+        self.clock = clock.VirtualClock(free_running=True)
+        self.timers = timers.Timers(self.clock)
+        self.recording = ports.RecordingPort(self.clock)
+        self.old_port = keys_port
+        use_port(ports.OutputPort("recording", self.recording, clock=self.clock, threaded=False))
+
+    def tearDown(self):
+        use_port(self.old_port)
+
+    def sent(self, *types):
+        """
+        :param types: Message types or nothing for every type
+        :return: The messages of those types that have been sent
+        """
+        return [msg for _, msg in self.recording.messages if not types or msg.type in types]
+
+
+class ChannelTestCase(PlaybackTestCase):
+    def setUp(self):
+        super(ChannelTestCase, self).setUp()
+        self.channel = Channel(3, clock=self.clock, timers=self.timers)
+
+    def play(self, note=60, velocity=100):
+        self.channel.send_message(event.Event.make(note_on, channel=3, note=note, velocity=velocity))
+        return self.sent(note_on)[-1]
+
+    def test_volume_rebuilds_chain(self):
+        length = len(self.channel.build_chain(self.channel.parameters))
+        self.assertEqual(100, self.play().velocity)
+        self.channel.volume = 0.5
+        self.assertEqual(length + 1, len(self.channel.build_chain(self.channel.parameters)))
+        self.assertEqual(50, self.play().velocity)
+        self.channel.volume = VOLUME_DEFAULT
+        self.assertEqual(length, len(self.channel.build_chain(self.channel.parameters)))
+        self.assertEqual(100, self.play().velocity)
+
+    def test_gain(self):
+        self.channel.send_message(event.Event.make("control_change", channel=3, control=VOLUME_CONTROL, value=80))
+        self.play()
+        # A sounding note follows the gain through the channel volume rather than its velocity
+        self.channel.gain = 0.5
+        self.assertEqual(100, self.play().velocity)
+        self.channel.send_message(event.Event.make(note_off, channel=3, note=60))
+        self.channel.gain = 0.25
+        self.channel.gain = 1.
+        self.play()
+        self.assertEqual([80, 40, 80], [msg.value for msg in self.sent("control_change")])
+
+    def test_volume_control(self):
+        # The channel volume may have been left anywhere by another track so the first message sets it
+        self.play()
+        self.channel.send_message(event.Event.make("control_change", channel=3, control=VOLUME_CONTROL,
+                                                   value=CONTROLLER_VOLUME_DEFAULT))
+        self.channel.send_message(event.Event.make("control_change", channel=3, control=VOLUME_CONTROL, value=60))
+        self.channel.reset_volume_control()
+        self.assertEqual([CONTROLLER_VOLUME_DEFAULT, 60, CONTROLLER_VOLUME_DEFAULT],
+                         [msg.value for msg in self.sent("control_change")])
+        self.assertEqual(note_on, self.sent()[1].type)
+
+    def test_listening_queue(self):
+        self.play(60)
+        self.channel.listening_queue = Queue()
+        self.play(62)
+        self.assertEqual(62, self.channel.listening_queue.get_nowait().note)
+        self.assertTrue(self.channel.listening_queue.empty())
+
+    def test_percussive(self):
+        self.assertEqual(3, self.play().channel)
+        self.channel.instrument_type = "percussive"
+        self.assertEqual(PERCUSSION_CHANNEL, self.play().channel)
+        self.channel.instrument_type = "piano"
+        self.assertEqual(3, self.play().channel)
+
+
+class TrackTestCase(PlaybackTestCase):
+    def track(self, name="Test_4.mid", **kwargs):
+        """
+        :param name: The name of a file in the audio media directory
+        :return: A Track playing that file with the clock of the test
+        """
+        return Track(os.path.join(dir_path, "..", "media", "audio", name), clock=self.clock, **kwargs)
+
+    def test_timing(self):
+        def note_ons(msgs):
+            """The time, channel, note and velocity of each note_on. Note_offs are left out as the voice allocator
+            drops those for notes that have already stopped."""
+            return [(time, (msg.channel, msg.note, msg.velocity)) for time, msg in msgs
+                    if msg.type == note_on and msg.velocity > 0]
+
+        path = os.path.join(dir_path, "..", "media", "audio", "Test_4.mid")
+        midi_file = mido.MidiFile(path)
+        position = 0.
+        expected = []
+        for msg in midi_file:
+            position += msg.time
+            expected.append((position, msg))
+        expected = note_ons(expected)
+        self.track().run()
+        played = note_ons(self.recording.messages)
+        self.assertEqual([note for _, note in expected], [note for _, note in played])
+        for (expected_time, _), (time, _) in zip(expected, played):
+            self.assertAlmostEqual(expected_time, time, places=6)
+        self.assertAlmostEqual(midi_file.length, self.clock.now(), places=6)
+
+    def test_max_duration(self):
+        track = self.track()
+        for channel in track.channels:
+            channel.voices = voices.VoiceAllocator(track.timers, channel.stop_voice, max_duration=0.1)
+        track.run()
+        # Timers expire the voices as the clock goes by without running it on past the end
+        self.assertGreater(sum(channel.voices.expired for channel in track.channels), 0)
+        self.assertAlmostEqual(track.timeline.length, self.clock.now(), places=6)
+        started = {}
+        for time, msg in self.recording.messages:
+            if msg.type == note_on and msg.velocity > 0:
+                started[(msg.channel, msg.note)] = time
+            elif msg.type in NOTE_TYPES and (msg.channel, msg.note) in started:
+                self.assertLessEqual(time - started.pop((msg.channel, msg.note)), 0.1 + 1e-9)
+
+    def test_instrument_type_index(self):
+        track = self.track()
+        view = ChannelView(track, numbers=[0], instrument_types=["strings"])
+        channel = track.channels[5]
+        self.assertNotIn(channel, view.channels)
+        version = track.index_version
+
+        channel.instrument_type = "strings"
+        self.assertGreater(track.index_version, version)
+        self.assertIn(channel, track.channels_with_instrument_type(InstrumentType.strings))
+        self.assertNotIn(channel, track.channels_with_instrument_type(InstrumentType.piano))
+        expected = {track.channels[0]} | set(track.channels_with_instrument_type("strings"))
+        self.assertEqual(sorted(expected, key=lambda c: c.number), list(view))
+
+        # A new version of the same type of instrument leaves the index as it is
+        version = track.index_version
+        channel.instrument_version = 3
+        self.assertEqual(version, track.index_version)
+
+        channel.instrument_type = "brass"
+        self.assertNotIn(channel, view)
+        self.assertIn(channel, track.channels_with_instrument_type("brass"))
+
+    def test_route(self):
+        track = self.track()
+        drums, guitar = track.channel_mappers[:2]
+
+        def route(msg_type, channel, **values):
+            routed = track.route(event.Event.make(msg_type, channel=channel, **values))
+            return None if routed is None else routed.channel
+
+        self.assertEqual(drums.output_channel, route(note_on, drums.input_channels[0], note=36, velocity=100))
+        self.assertIsNone(route(note_on, drums.input_channels[1], note=36, velocity=100))
+        # Other messages pass from every input channel of a mapper
+        self.assertEqual(drums.output_channel, route(note_off, drums.input_channels[1], note=36))
+        self.assertEqual(guitar.output_channel, route("control_change", guitar.input_channels[2], control=10))
+        # Leaving out the channel volume that goes ahead of the first message on each channel
+        self.assertEqual([drums.output_channel, drums.output_channel, guitar.output_channel],
+                         [msg.channel for msg in self.sent() if msg.type != "control_change" or msg.control == 10])
+
+        drums.mode = 1
+        self.assertEqual(drums.input_channels[1], track.current_channels[0])
+        self.assertIsNone(route(note_on, drums.input_channels[0], note=36, velocity=100))
+        self.assertEqual(drums.output_channel, route(note_on, drums.input_channels[1], note=36, velocity=100))
+
+    def test_crossfade(self):
+        mixer = Mixer(self.clock)
+        read = []
+        finish_times = {}
+        done = Event()
+
+        def message_read_listener(msg):
+            if not read and self.clock.now() >= 1.:
+                read.append(self.clock.now())
+                mixer.crossfade(outgoing, incoming, 1.)
+                # As the scoreboard does, which has no say in when the track starts
+                incoming.start()
+
+        def finish(track, track_finish):
+            track_finish()
+            finish_times[track] = self.clock.now()
+            if track is incoming:
+                done.set()
+
+        outgoing = self.track(mixer=mixer, message_read_listener=message_read_listener)
+        incoming = self.track(mixer=mixer)
+        for track in (outgoing, incoming):
+            track.finish = partial(finish, track, track.finish)
+        outgoing.start()
+        self.assertTrue(done.wait(10.))
+        # The tracks share channels so the incoming track only set its programs once the outgoing track had faded
+        # out and finished
+        fade_start = read[0]
+        self.assertAlmostEqual(fade_start + 1., finish_times[outgoing], delta=ENVELOPE_STEP)
+        program_times = [time for time, msg in self.recording.messages if msg.type == "program_change"]
+        self.assertGreaterEqual(min(time for time in program_times if time >= fade_start), finish_times[outgoing])
+        # The outgoing track faded through the channel volume, so notes that were sounding faded too, and set the
+        # volume back to the default when it finished
+        volumes = [msg.value for time, msg in self.recording.messages if fade_start < time <= finish_times[outgoing]
+                   and msg.type == "control_change" and msg.control == VOLUME_CONTROL and msg.channel == 0]
+        fade = volumes[:volumes.index(CONTROLLER_VOLUME_DEFAULT)]
+        self.assertTrue(fade)
+        self.assertEqual(sorted(fade, reverse=True), fade)
+        self.assertLess(fade[-1], 0.1 * CONTROLLER_VOLUME_DEFAULT)
+
+    def test_loop_stops_notes(self):
+        stopped = set()
+
+        def message_read_listener(msg):
+            if self.clock.now() >= end_position and not track.is_stopping:
+                # The first event of the second pass, by which time the notes of the first pass have been stopped
+                stopped.update((msg.channel, msg.note) for msg in self.sent(note_off))
+                track.stop()
+
+        track = self.track(is_looping=True, message_read_listener=message_read_listener)
+        track.set_loop(0, 10)
+        end_position = track.timeline.seconds_at_tick(10)
+        track.run()
+        notes = {(msg.channel, msg.note) for msg in self.sent(note_on) if msg.velocity > 0}
+        self.assertTrue(notes)
+        self.assertEqual(notes, stopped)
+
+    def test_seek(self):
+        def state(msg):
+            """The state a program or control change sets and the value it sets it to"""
+            if msg.type == "program_change":
+                return (msg.type, msg.channel), msg.program
+            return (msg.type, msg.channel, msg.control), msg.value
+
+        path = os.path.join(dir_path, "..", "media", "audio", "Test_4.mid")
+        position = 0.
+        states = {}
+        note_ons = []
+        for msg in mido.MidiFile(path):
+            position += msg.time
+            if msg.type == note_on and msg.velocity > 0:
+                note_ons.append((position, msg.channel, msg.note))
+            elif msg.type in ("program_change", "control_change") and position < 3.:
+                key, value = state(msg)
+                states[key] = value
+        read = []
+        track = self.track(message_read_listener=read.append)
+        track.seek(seconds=3.)
+        track.run()
+        # The latest programs and controllers from before the point are chased through the listener before anything
+        # else is read
+        chase_length = len(track.timeline.chase(track.timeline.index_at_time(3.)))
+        chased = [msg for msg in read[:chase_length] if msg.type in ("program_change", "control_change")]
+        self.assertEqual(states, dict(state(msg) for msg in chased))
+        played = [(time, msg.channel, msg.note) for time, msg in self.recording.messages
+                  if msg.type == note_on and msg.velocity > 0]
+        expected = [(time - 3., channel, note) for time, channel, note in note_ons if time >= 3.]
+        self.assertEqual([note[1:] for note in expected], [note[1:] for note in played])
+        for (expected_time, _, _), (time, _, _) in zip(expected, played):
+            self.assertAlmostEqual(expected_time, time, places=6)
+
+    def test_stop_before_begin(self):
+        read = []
+        track = self.track(message_read_listener=read.append)
+        track.stop()
+        track.run()
+        self.assertEqual([], read)
+        self.assertFalse(track.is_playing)
+
+    def test_stop_during_hand_off(self):
+        read = []
+        next_read = []
+        next_track = self.track("channels_test.mid", message_read_listener=next_read.append)
+
+        def message_read_listener(msg):
+            read.append(msg)
+            if len(read) == 1:
+                track.hand_off(next_track)
+                # As the state does, stopping the track that is taking over
+                next_track.stop()
+
+        track = self.track(message_read_listener=message_read_listener)
+        track.run()
+        # The outgoing track stopped straight away rather than playing on to the bar
+        self.assertEqual(1, len(read))
+        self.assertEqual(0., self.clock.now())
+        self.assertIsNone(track.next_track)
+        self.assertIsNone(next_track.previous_track)
+        self.assertFalse(next_track.is_playing)
+        self.assertEqual([], next_read)
+
+    def test_back_to_back_hand_offs(self):
+        read = {}
+        tracks = []
+
+        def message_read_listener(name, msg):
+            read.setdefault(name, []).append(self.clock.now())
+            if name == "first" and len(read[name]) == 1:
+                # As the state does when two tracks are selected quickly, the second hands off before it has started
+                first.hand_off(second)
+                second.hand_off(third)
+                tracks.extend((first.next_track, second.previous_track, third.previous_track))
+
+        first, second, third = [self.track(message_read_listener=partial(message_read_listener, name))
+                                for name in ("first", "second", "third")]
+        first.run()
+        third.join(10.)
+        # The track that was playing handed off to the last track chosen, which started at the bar on its own
+        self.assertEqual([third, None, first], tracks)
+        self.assertNotIn("second", read)
+        self.assertFalse(second.is_playing)
+        self.assertAlmostEqual(first.next_bar(read["first"][0]), read["third"][0], places=6)
+        self.assertIsNone(third.previous_track)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,245 @@
+import unittest
+from threading import Lock
+
+from clock import VirtualClock
+
+
+class Ramp(object):
+    """A linear change in a value over time"""
+
+    def __init__(self, start_time, seconds, start_value, end_value):
+        """
+
+        :param start_time: The time at which the change starts
+        :param seconds: How long the change takes
+        :param start_value: The value at the start
+        :param end_value: The value at the end
+        """
+        self.start_time = start_time
+        self.seconds = seconds
+        self.start_value = start_value
+        self.end_value = end_value
+
+    def value_at(self, time):
+        """
+        :param time: A time
+        :return: The value at that time
+        """
+        if self.seconds <= 0:
+            return self.end_value
+        fraction = min(max((time - self.start_time) / self.seconds, 0.), 1.)
+        return self.start_value + fraction * (self.end_value - self.start_value)
+
+    def is_finished_at(self, time):
+        return time >= self.start_time + self.seconds
+
+
+class Parameter(object):
+    """A continuous value that is output whenever its quantized value changes"""
+
+    def __init__(self, quantize, output, value, read=None):
+        """
+
+        :param quantize: A function that takes a value and returns what is actually output (e.g. a midi data byte)
+        :param output: A function that takes a quantized value and outputs it (e.g. by sending a control change)
+        :param value: The value that has already been output
+        :param read: A function returning the current value if it can also be changed elsewhere or None
+        """
+        self.quantize = quantize
+        self.output = output
+        self.value = value
+        self.default = value
+        self.read = read
+        self.sent = quantize(read() if read is not None else value)
+        self.ramp = None
+
+    def value_at(self, time):
+        """
+        :param time: A time
+        :return: The value of this parameter at that time
+        """
+        if self.ramp is not None:
+            return self.ramp.value_at(time)
+        return self.read() if self.read is not None else self.value
+
+
+class Automation(object):
+    """
+    Moves the continuous parameters of a channel (e.g. pitch bend or modulation) towards new values over time.
+
+    A parameter is only output when its quantized value changes, and all the parameters of the channel are updated
+    together at most max_rate times a second. Values set between updates replace each other so however often they are
+    set the link only carries the latest of them.
+    """
+
+    def __init__(self, timers, max_rate):
+        """
+
+        :param timers: The Timers that updates are called from
+        :param max_rate: The most times a second that parameters are updated. 0 for no limit.
+        """
+        self.timers = timers
+        self.clock = timers.clock
+        self.interval = 1. / max_rate if max_rate > 0 else 0.
+        self.lock = Lock()
+        self.parameters = {}
+        # The pending update or None
+        self.timer = None
+        self.last_update = None
+
+    def add(self, name, quantize, output, value=0., read=None):
+        """
+        Add a parameter (see Parameter)
+        :param name: The name it is set by
+        """
+        self.parameters[name] = Parameter(quantize, output, value, read)
+
+    def value(self, name):
+        """
+        :param name: The name of a parameter
+        :return: The value it is at or moving to
+        """
+        parameter = self.parameters[name]
+        return parameter.ramp.end_value if parameter.ramp is not None else parameter.value_at(self.clock.now())
+
+    def set(self, name, value, seconds=0.):
+        """
+        Move a parameter to a new value
+        :param name: The name of the parameter
+        :param value: The value to move to
+        :param seconds: How long the move should take. The parameter jumps to the value at the next update if 0.
+        """
+        with self.lock:
+            now = self.clock.now()
+            parameter = self.parameters[name]
+            parameter.ramp = Ramp(now, seconds, parameter.value_at(now), value)
+            if self.timer is None:
+                delay = 0. if self.last_update is None else max(self.last_update + self.interval - now, 0.)
+                self.timer = self.timers.call_later(delay, self.update)
+
+    def reset(self):
+        """
+        Cancel any pending update and output the value that each parameter was added with if it has moved away from
+        it, e.g. so that a parameter left part way through a ramp is not carried over to whatever plays next.
+        Parameters that are read from elsewhere are left as they are.
+        """
+        outputs = []
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            for parameter in self.parameters.values():
+                parameter.ramp = None
+                if parameter.read is not None:
+                    continue
+                parameter.value = parameter.default
+                quantized = parameter.quantize(parameter.default)
+                if quantized != parameter.sent:
+                    parameter.sent = quantized
+                    outputs.append((parameter.output, quantized))
+        for output, quantized in outputs:
+            output(quantized)
+
+    def update(self):
+        """Output every parameter whose quantized value has changed, continuing while any are still moving"""
+        outputs = []
+        with self.lock:
+            self.timer = None
+            now = self.clock.now()
+            self.last_update = now
+            is_moving = False
+            for parameter in self.parameters.values():
+                if parameter.ramp is None:
+                    continue
+                value = parameter.ramp.value_at(now)
+                quantized = parameter.quantize(value)
+                if parameter.read is not None:
+                    # Something else may have changed the value since it was last output
+                    parameter.sent = parameter.quantize(parameter.read())
+                if quantized != parameter.sent:
+                    parameter.sent = quantized
+                    outputs.append((parameter.output, quantized))
+                if parameter.ramp.is_finished_at(now):
+                    parameter.value = value
+                    parameter.ramp = None
+                else:
+                    is_moving = True
+            if is_moving:
+                self.timer = self.timers.call_later(self.interval, self.update)
+        for output, quantized in outputs:
+            output(quantized)
+
+
+def byte(value):
+    """
+    :param value: A value from 0 to 127
+    :return: The nearest midi data byte
+    """
+    return min(max(int(round(value)), 0), 127)
+
+
+class MockTimers(object):
+    def __init__(self, clock):
+        self.clock = clock
+        self.callbacks = []
+
+    def call_later(self, seconds, callback):
+        self.callbacks.append((self.clock.now() + seconds, callback))
+        return self
+
+    def cancel(self):
+        self.callbacks = []
+
+    def run(self, until):
+        while self.callbacks and self.callbacks[0][0] <= until:
+            deadline, callback = self.callbacks.pop(0)
+            self.clock.advance(deadline - self.clock.now())
+            callback()
+        self.clock.advance(until - self.clock.now())
+
+
+class AutomationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock()
+        self.timers = MockTimers(self.clock)
+        self.automation = Automation(self.timers, max_rate=10)
+        self.sent = []
+        self.automation.add("modulation", byte, self.sent.append)
+
+    def test_only_changes(self):
+        self.automation.set("modulation", 0)
+        self.timers.run(1.)
+        self.assertEqual([], self.sent)
+        self.automation.set("modulation", 64)
+        self.automation.set("modulation", 64.2)
+        self.timers.run(2.)
+        self.assertEqual([64], self.sent)
+
+    def test_rate(self):
+        for step in range(100):
+            self.automation.set("modulation", step)
+            self.timers.run(step * 0.01)
+        self.timers.run(2.)
+        # A second of changes at 100 a second only makes around 10 updates
+        self.assertLessEqual(len(self.sent), 11)
+        self.assertEqual(99, self.sent[-1])
+
+    def test_ramp(self):
+        self.automation.set("modulation", 100, seconds=1.)
+        self.timers.run(0.5)
+        self.assertEqual(50, self.sent[-1])
+        self.assertEqual(100, self.automation.value("modulation"))
+        self.timers.run(2.)
+        self.assertEqual([10, 20, 30, 40, 50, 60, 70, 80, 90, 100], self.sent)
+
+    def test_reset(self):
+        self.automation.set("modulation", 100, seconds=1.)
+        self.timers.run(0.5)
+        self.automation.reset()
+        self.timers.run(2.)
+        self.assertEqual([10, 20, 30, 40, 50, 0], self.sent)
+        self.assertEqual(0, self.automation.value("modulation"))
+
+
+if __name__ == "__main__":
+    unittest.main()
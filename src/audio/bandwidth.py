@@ -0,0 +1,84 @@
+import unittest
+
+from clock import VirtualClock
+
+# A DIN midi link runs at 31250 baud with 10 bits to a byte
+DIN_BYTES_PER_SECOND = 3125
+
+# How many bytes a port can send at once after being idle
+DEFAULT_BURST = 96
+
+# Messages that are dropped rather than deferred when a port is over budget. Everything else waits its turn.
+DEFAULT_DROP_TYPES = ("aftertouch", "polytouch")
+
+
+class Bandwidth(object):
+    """How fast the ports of a registry may send and what they do when they are sending too fast"""
+
+    def __init__(self, bytes_per_second=DIN_BYTES_PER_SECOND, burst=DEFAULT_BURST, drop_types=DEFAULT_DROP_TYPES):
+        """
+
+        :param bytes_per_second: The rate at which bytes can be sent
+        :param burst: The most bytes that can be sent at once
+        :param drop_types: Message types that are dropped when there is no budget for them rather than deferred
+        """
+        if bytes_per_second <= 0 or burst < 3:
+            raise AssertionError("A bandwidth needs a positive rate and room for a message, not {} bytes a second and "
+                                 "a burst of {}".format(bytes_per_second, burst))
+        self.bytes_per_second = bytes_per_second
+        self.burst = burst
+        self.drop_types = frozenset(drop_types)
+
+
+class TokenBucket(object):
+    """Allows a number of bytes a second to be sent, with bursts of up to a capacity after quiet periods"""
+
+    def __init__(self, rate, capacity, clock):
+        """
+
+        :param rate: The bytes added each second
+        :param capacity: The most bytes that can be saved up
+        :param clock: The clock that the rate is measured with
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.last_time = clock.now()
+
+    def refill(self):
+        now = self.clock.now()
+        self.tokens = min(self.tokens + (now - self.last_time) * self.rate, self.capacity)
+        self.last_time = now
+
+    def delay(self, cost):
+        """
+        :param cost: A number of bytes
+        :return: How long until that many bytes can be sent (0 if they can be sent now)
+        """
+        self.refill()
+        return max(cost - self.tokens, 0) / float(self.rate)
+
+    def take(self, cost):
+        """
+        Spend bytes, going into debt if there were not enough so that messages that must be sent are paid for later
+        :param cost: A number of bytes
+        """
+        self.refill()
+        self.tokens -= cost
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    def test_rate(self):
+        clock = VirtualClock()
+        bucket = TokenBucket(1000, 6, clock)
+        self.assertEqual(0., bucket.delay(6))
+        bucket.take(6)
+        self.assertAlmostEqual(0.003, bucket.delay(3))
+        clock.advance(1.)
+        self.assertEqual(0., bucket.delay(6))
+        self.assertEqual(6, bucket.tokens)
+
+
+if __name__ == "__main__":
+    unittest.main()
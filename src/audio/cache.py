@@ -0,0 +1,152 @@
+import hashlib
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import mido
+
+import timeline
+
+logger = logging.getLogger(__name__)
+
+MAGIC = "DMXT"
+# Increment whenever the layout of a cached timeline changes
+VERSION = 3
+
+# magic, version, source mtime, source size, ticks per beat, tempo, beats per bar, length
+HEADER = struct.Struct("<4sHdqIIId")
+# number of items in an array
+ARRAY_HEADER = struct.Struct("<I")
+
+
+class TimelineCache(object):
+    """
+    Keeps compiled timelines on disk so that midi files only have to be parsed again when they change. Entries are
+    keyed by the path of the midi file and invalidated when its modification time or size changes.
+    """
+
+    def __init__(self, directory):
+        """
+
+        :param directory: The directory in which cached timelines are kept
+        """
+        self.directory = directory
+
+    def path_for(self, file_path):
+        """
+        :param file_path: The path to a midi file
+        :return: The path of the cache entry for that file
+        """
+        name = hashlib.sha1(os.path.realpath(file_path)).hexdigest()
+        return os.path.join(self.directory, "{}.timeline".format(name))
+
+    def load(self, file_path):
+        """
+        Load the timeline for a midi file, compiling and caching it if there is no up to date entry
+        :param file_path: The path to a midi file
+        :return: A Timeline
+        """
+        stat = os.stat(file_path)
+        cache_path = self.path_for(file_path)
+        compiled = self.read(cache_path, stat)
+        if compiled is None:
+            compiled = timeline.Timeline.from_midi_file(mido.MidiFile(file_path))
+            self.write(cache_path, stat, compiled)
+        return compiled
+
+    # noinspection PyMethodMayBeStatic
+    def read(self, cache_path, stat):
+        """
+        Read a cache entry
+        :param cache_path: The path of the cache entry
+        :param stat: The result of os.stat for the midi file
+        :return: A Timeline or None if there is no valid entry
+        """
+        try:
+            with open(cache_path, "rb") as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        try:
+            magic, version, mtime, size, ticks_per_beat, tempo, beats_per_bar, length = HEADER.unpack_from(data, 0)
+            if magic != MAGIC or version != VERSION or mtime != stat.st_mtime or size != stat.st_size:
+                return None
+            compiled = timeline.Timeline(ticks_per_beat)
+            compiled.tempo = tempo
+            compiled.beats_per_bar = beats_per_bar
+            compiled.length = length
+            offset = HEADER.size
+            for name in timeline.Timeline.ARRAYS:
+                values = getattr(compiled, name)
+                count, = ARRAY_HEADER.unpack_from(data, offset)
+                offset += ARRAY_HEADER.size
+                end = offset + count * values.itemsize
+                if end > len(data):
+                    return None
+                values.fromstring(data[offset:end])
+                offset = end
+            return compiled
+        except struct.error:
+            return None
+
+    def write(self, cache_path, stat, compiled):
+        """
+        Write a cache entry. Failure is logged rather than raised as the cache is only an optimisation.
+        :param cache_path: The path of the cache entry
+        :param stat: The result of os.stat for the midi file
+        :param compiled: The Timeline compiled from the midi file
+        """
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # Write to a temporary file of its own first so that a partly written entry is never read, even when
+            # several threads write the same entry at once
+            fd, temp_path = tempfile.mkstemp(dir=self.directory)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(HEADER.pack(MAGIC, VERSION, stat.st_mtime, stat.st_size, compiled.ticks_per_beat,
+                                        compiled.tempo, compiled.beats_per_bar, compiled.length))
+                    for name in timeline.Timeline.ARRAYS:
+                        values = getattr(compiled, name)
+                        f.write(ARRAY_HEADER.pack(len(values)))
+                        f.write(values.tostring())
+                os.rename(temp_path, cache_path)
+            except (IOError, OSError):
+                os.remove(temp_path)
+                raise
+        except (IOError, OSError) as e:
+            logger.warning("Could not cache timeline at {}: {}".format(cache_path, e))
+
+
+class TimelineCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = TimelineCache(self.directory)
+        self.compiled = timeline.Timeline(96)
+        self.compiled.append(0.5, [0x91, 60, 100], 48)
+        self.compiled.append(1., [0xC2, 33], 96)
+        self.compiled.length = 2.
+        self.stat = os.stat(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        cache_path = self.cache.path_for("track.mid")
+        self.cache.write(cache_path, self.stat, self.compiled)
+        loaded = self.cache.read(cache_path, self.stat)
+        self.assertEqual([os.path.basename(cache_path)], os.listdir(self.directory))
+        self.assertEqual(96, loaded.ticks_per_beat)
+        self.assertEqual(2., loaded.length)
+        for name in timeline.Timeline.ARRAYS:
+            self.assertEqual(getattr(self.compiled, name), getattr(loaded, name))
+
+    def test_missing(self):
+        self.assertIsNone(self.cache.read(self.cache.path_for("track.mid"), self.stat))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,333 @@
+import ctypes
+import ctypes.util
+import sys
+import unittest
+from heapq import heappush, heapify
+from itertools import count
+from threading import Condition, Thread, current_thread
+import time
+
+# The id of the clock that counts up steadily from boot on each platform
+CLOCK_MONOTONIC_IDS = {"linux": 1, "darwin": 6}
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def clock_gettime_monotonic():
+    """
+    :return: A function returning the time in seconds of the monotonic clock read with clock_gettime or None if the
+    platform does not have one
+    """
+    clock_id = CLOCK_MONOTONIC_IDS.get(sys.platform.rstrip("0123456789"))
+    library_name = ctypes.util.find_library("rt") or ctypes.util.find_library("c")
+    if clock_id is None or library_name is None:
+        return None
+    try:
+        clock_gettime = ctypes.CDLL(library_name, use_errno=True).clock_gettime
+    except (OSError, AttributeError):
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    def monotonic():
+        spec = timespec()
+        if clock_gettime(clock_id, ctypes.byref(spec)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "clock_gettime failed: {}".format(errno))
+        return spec.tv_sec + spec.tv_nsec * 1e-9
+
+    return monotonic
+
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2 has no monotonic clock of its own. time.time jumps when the system clock is set (e.g. by ntp on a pi
+    # that has just found the network) so it is only used if clock_gettime cannot be.
+    monotonic = clock_gettime_monotonic() or time.time
+
+
+class WallClock(object):
+    """Real time"""
+
+    # noinspection PyMethodMayBeStatic
+    def now(self):
+        """
+        :return: The current time in seconds
+        """
+        return monotonic()
+
+    # noinspection PyMethodMayBeStatic
+    def sleep(self, seconds):
+        """
+        Block the calling thread
+        :param seconds: How long to block for
+        """
+        time.sleep(seconds)
+
+    # noinspection PyMethodMayBeStatic
+    def new_condition(self):
+        """
+        :return: A condition for a thread to wait on with wait
+        """
+        return Condition()
+
+    # noinspection PyMethodMayBeStatic
+    def wait(self, condition, seconds):
+        """
+        Wait on a condition that the calling thread holds until it is notified, for no longer than a time
+        :param condition: A threading.Condition
+        :param seconds: The longest time to wait for or None to wait until notified
+        """
+        condition.wait(seconds)
+
+    # noinspection PyMethodMayBeStatic
+    def notify(self, condition):
+        """
+        Wake the threads waiting on a condition that the calling thread holds
+        :param condition: A condition made by new_condition
+        """
+        condition.notify_all()
+
+    def register(self, thread):
+        """Time does not wait for threads on a wall clock (see VirtualClock.register)"""
+
+    def unregister(self, thread):
+        """Time does not wait for threads on a wall clock (see VirtualClock.register)"""
+
+
+wall_clock = WallClock()
+
+
+class VirtualClock(object):
+    """
+    Time that only passes when told to so that playback can run faster than real time in tests and benchmarks.
+
+    A stepped clock moves forward when advance is called and threads sleeping on it wake once their time has come.
+
+    A free running clock jumps to the earliest time that any thread is sleeping or waiting until, but only while some
+    thread is sleeping and every registered thread (see register) is sleeping or waiting on the clock. A thread that
+    is woken counts as busy until it sleeps again, so the threads that play tracks and call timers take turns in time
+    order and playback is the same every run however the threads are scheduled. Threads that are not registered never
+    hold the clock back, and a thread that only waits (e.g. for timers) never moves it on by itself.
+    """
+
+    def __init__(self, start=0., free_running=False):
+        """
+
+        :param start: The time the clock starts at in seconds
+        :param free_running: If True time jumps forward once every registered thread is idle rather than waiting for
+        advance
+        """
+        self.__time = start
+        self.free_running = free_running
+        self.condition = Condition()
+        # (deadline, sequence number, thread) for each thread sleeping or waiting on the clock
+        self.deadlines = []
+        self.sequence = count()
+        # How many threads are sleeping, as opposed to waiting
+        self.sleepers = 0
+        # The threads that time waits for, and those of them that are sleeping or waiting
+        self.threads = set()
+        self.idle = set()
+        # Threads waiting on the condition of the clock until they are notified
+        self.waiting = set()
+
+    def now(self):
+        """
+        :return: The current time in seconds
+        """
+        return self.__time
+
+    def register(self, thread):
+        """
+        Make a free running clock wait for a thread to be idle before moving forward. Called before the thread starts
+        so that time cannot move on before it has had a chance to run.
+        :param thread: A Thread that sleeps or waits on this clock
+        """
+        with self.condition:
+            self.threads.add(thread)
+
+    def unregister(self, thread):
+        """
+        Stop waiting for a thread, e.g. when it has finished
+        :param thread: A registered Thread
+        """
+        with self.condition:
+            self.threads.discard(thread)
+            self.idle.discard(thread)
+            self.__run()
+
+    def advance(self, seconds):
+        """
+        Move time forward, waking threads whose sleep has finished
+        :param seconds: How far to move
+        """
+        with self.condition:
+            self.__time += seconds
+            self.__wake()
+
+    def __wake(self):
+        """Mark the threads whose deadline has passed as busy and wake them. Called holding the condition."""
+        for deadline, _, thread in self.deadlines:
+            if deadline <= self.__time:
+                self.idle.discard(thread)
+        self.condition.notify_all()
+
+    def __run(self):
+        """Jump to the earliest deadline if the clock is free running, a thread is sleeping and every registered thread
+        is idle"""
+        if self.free_running and self.sleepers > 0 and self.idle >= self.threads:
+            self.__time = max(self.__time, self.deadlines[0][0])
+            self.__wake()
+
+    def __enter(self, seconds, is_sleeping):
+        """
+        Record that the calling thread is going to sleep or wait
+        :param seconds: How long it sleeps for or None if it waits to be notified
+        :param is_sleeping: True if it is sleeping rather than waiting
+        :return: Its deadline entry or None
+        """
+        thread = current_thread()
+        entry = None
+        if is_sleeping:
+            self.sleepers += 1
+        if seconds is not None:
+            entry = (self.__time + seconds, next(self.sequence), thread)
+            heappush(self.deadlines, entry)
+        else:
+            self.waiting.add(thread)
+        if thread in self.threads:
+            self.idle.add(thread)
+        self.__run()
+        return entry
+
+    def __leave(self, entry, is_sleeping):
+        """Record that the calling thread has woken"""
+        thread = current_thread()
+        if is_sleeping:
+            self.sleepers -= 1
+        if entry is not None:
+            self.deadlines.remove(entry)
+            heapify(self.deadlines)
+        self.waiting.discard(thread)
+        self.idle.discard(thread)
+        if thread not in self.threads:
+            # The clock may have been waiting for this thread's deadline to be left behind
+            self.__run()
+
+    def sleep(self, seconds):
+        """
+        Block the calling thread until the clock has moved forward
+        :param seconds: How far the clock must move
+        """
+        with self.condition:
+            entry = self.__enter(seconds, True)
+            try:
+                while self.__time < entry[0]:
+                    self.condition.wait()
+            finally:
+                self.__leave(entry, True)
+
+    def new_condition(self):
+        """
+        :return: The condition of this clock. A thread waiting on it counts as idle until it is notified with notify.
+        """
+        return self.condition
+
+    def wait(self, condition, seconds):
+        """
+        Wait on a condition that the calling thread holds until it is notified with notify, or until the clock has
+        moved forward. Any condition other than that of this clock (see new_condition) is released while waiting, and
+        a timed wait on it is not cut short by it being notified.
+        :param condition: A threading.Condition
+        :param seconds: How far the clock must move or None to wait until notified
+        """
+        if condition is not self.condition:
+            # The clock is taken before the condition is released so that a notify in between is not missed
+            self.condition.acquire()
+            condition.release()
+            try:
+                if seconds is None:
+                    self.wait(self.condition, None)
+                else:
+                    self.sleep(seconds)
+            finally:
+                self.condition.release()
+                condition.acquire()
+            return
+        entry = self.__enter(seconds, False)
+        try:
+            # Return on any wake up, as a condition wait may, so the caller checks what it is waiting for again
+            if entry is None or self.__time < entry[0]:
+                self.condition.wait()
+        finally:
+            self.__leave(entry, False)
+
+    def notify(self, condition):
+        """
+        Wake the threads waiting on a condition that the calling thread holds
+        :param condition: A threading.Condition
+        """
+        if condition is not self.condition:
+            # Also wakes threads that are waiting on other conditions, which check what they are waiting for again
+            condition.notify_all()
+        with self.condition:
+            self.idle -= self.waiting
+            self.condition.notify_all()
+
+
+class WallClockTestCase(unittest.TestCase):
+    def test_monotonic(self):
+        times = [wall_clock.now() for _ in range(1000)]
+        self.assertEqual(sorted(times), times)
+        start = wall_clock.now()
+        time.sleep(0.01)
+        self.assertAlmostEqual(0.01, wall_clock.now() - start, delta=0.05)
+
+
+class VirtualClockTestCase(unittest.TestCase):
+    def test_stepped(self):
+        clock = VirtualClock()
+        thread = Thread(target=clock.sleep, args=(1.,))
+        thread.start()
+        while not clock.deadlines:
+            thread.join(0.001)
+        clock.advance(0.5)
+        thread.join(0.05)
+        self.assertTrue(thread.is_alive())
+        clock.advance(0.5)
+        thread.join(1.)
+        self.assertFalse(thread.is_alive())
+
+    def test_free_running(self):
+        clock = VirtualClock(start=10., free_running=True)
+        clock.sleep(300.)
+        self.assertEqual(310., clock.now())
+
+    def test_wait_on_other_condition(self):
+        clock = VirtualClock(free_running=True)
+        condition = Condition()
+        notified = []
+        woken = []
+
+        def wait():
+            with condition:
+                while not notified:
+                    clock.wait(condition, None)
+                woken.append(clock.now())
+
+        thread = Thread(target=wait)
+        thread.start()
+        while not clock.waiting:
+            thread.join(0.001)
+        with condition:
+            notified.append(True)
+            clock.notify(condition)
+        thread.join(1.)
+        self.assertEqual([0.], woken)
+
+
+if __name__ == "__main__":
+    unittest.main()
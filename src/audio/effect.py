@@ -1,16 +1,24 @@
+import cPickle as pickle
 import json
 from audio import audio
+import timers
 import logging
 import os
-from threading import Thread
-from time import sleep
-from Queue import Queue
+from functools import partial
+from operator import attrgetter
+from threading import Lock
 import sys
 import inspect
 import re
 
-INTERVAL = 0.1
 EFFECT_LENGTH = 2
+# The combo table has an entry for every combination of buttons so the number of distinct buttons is limited
+MAX_BUTTONS = 16
+
+# Compiled configurations are kept next to the JSON with this extension
+COMPILED_EXTENSION = ".compiled"
+# Increment whenever the compiled form of a configuration changes
+COMPILED_VERSION = 2
 
 logging.basicConfig()
 
@@ -25,6 +33,169 @@ def convert(name):
     return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
 
 
+class ConfigurationError(AssertionError):
+    """An effects configuration that cannot be played"""
+
+
+def make_combo_table(combos, get_buttons=attrgetter("buttons")):
+    """
+    Give each button used by the combos a bit and work out which combos to play for every combination of buttons. A
+    combo defined for exactly the combination is played if there is one. Otherwise the combos for each single button
+    in the combination are stacked.
+    :param combos: A list of combos
+    :param get_buttons: A function that gives the buttons of a combo
+    :return: (a dictionary of bits by button name, a list of tuples of combos indexed by button bitmask)
+    """
+    buttons = sorted(set(button for combo in combos for button in get_buttons(combo)))
+    if len(buttons) > MAX_BUTTONS:
+        raise ConfigurationError("Combos use {} buttons. The most allowed is {}".format(len(buttons), MAX_BUTTONS))
+    button_bits = {button: 1 << n for n, button in enumerate(buttons)}
+
+    combos_by_mask = {}
+    for combo in combos:
+        combos_by_mask[sum(button_bits[button] for button in get_buttons(combo))] = combo
+
+    table = []
+    for mask in range(1 << len(buttons)):
+        if mask in combos_by_mask:
+            table.append((combos_by_mask[mask],))
+        else:
+            table.append(tuple(combos_by_mask[bit] for bit in button_bits.values()
+                               if mask & bit and bit in combos_by_mask))
+    return button_bits, table
+
+
+def effect_names():
+    """
+    :return: The names of the effects that a configuration can use
+    """
+    return {name for name, cls in Effect.classes.items() if issubclass(cls, Effect) and cls.apply != Effect.apply}
+
+
+def compile_effect(effect_dict):
+    """
+    Check an effect dictionary and resolve the names in it
+    :param effect_dict: A dictionary describing an effect
+    :return: A new dictionary with instrument type names replaced by numbers
+    :raises ConfigurationError: If the effect could not be played
+    """
+    if not isinstance(effect_dict, dict):
+        raise ConfigurationError("An effect must be a dictionary, not {}".format(effect_dict))
+    compiled = dict(effect_dict)
+    name = compiled.get("name")
+    if name not in effect_names():
+        raise ConfigurationError("No effect named {}".format(name))
+    for key in ("length", "ramp"):
+        if key in compiled and not (isinstance(compiled[key], (int, float)) and compiled[key] >= 0):
+            raise ConfigurationError("The {} of {} must be a number of seconds, not {}".format(key, name, compiled[key]))
+    if "channels" in compiled:
+        channels = compiled["channels"]
+        if not isinstance(channels, list) or not all(isinstance(n, int) and 0 <= n < 16 for n in channels):
+            raise ConfigurationError("The channels of {} must be numbers from 0 to 15, not {}".format(name, channels))
+        compiled["channels"] = sorted(set(channels))
+    if "instrument_types" in compiled:
+        if not isinstance(compiled["instrument_types"], list):
+            raise ConfigurationError("The instrument types of {} must be a list, not {}".format(
+                name, compiled["instrument_types"]))
+        instrument_types = []
+        for instrument_type in compiled["instrument_types"]:
+            if isinstance(instrument_type, basestring):
+                if instrument_type not in audio.InstrumentType.instrument_type_dict:
+                    raise ConfigurationError("No instrument type named {}".format(instrument_type))
+                instrument_type = audio.InstrumentType.with_name(instrument_type)
+            elif not (isinstance(instrument_type, int) and 0 <= instrument_type < 16):
+                raise ConfigurationError("Instrument types must be names or numbers from 0 to 15, not {}".format(
+                    instrument_type))
+            instrument_types.append(instrument_type)
+        compiled["instrument_types"] = sorted(set(instrument_types))
+    if "instrument_group" in compiled and compiled["instrument_group"] not in \
+            audio.InstrumentGroup.instrument_group_dict:
+        raise ConfigurationError("No instrument group named {}".format(compiled["instrument_group"]))
+    # Effects without a value play 0, which is not a value every effect can play
+    value = Effect.classes[name].compile_value(compiled.get("value", 0))
+    if "value" in compiled:
+        compiled["value"] = value
+    return compiled
+
+
+def compile_configuration(combo_dicts):
+    """
+    Check an effects configuration and work out everything about it that does not depend on a track
+    :param combo_dicts: A list of combo dictionaries as loaded from JSON
+    :return: (a list of compiled combo dictionaries, a dictionary of bits by button name, a list of tuples of combo
+    indices indexed by button bitmask) (see make_combo_table)
+    :raises ConfigurationError: If the configuration could not be played
+    """
+    if not isinstance(combo_dicts, list):
+        raise ConfigurationError("A configuration must be a list of combos")
+    compiled = []
+    masks = set()
+    for n, combo_dict in enumerate(combo_dicts):
+        try:
+            if not isinstance(combo_dict, dict):
+                raise ConfigurationError("A combo must be a dictionary")
+            buttons = combo_dict.get("buttons")
+            if not isinstance(buttons, list) or not buttons or \
+                    not all(isinstance(button, basestring) for button in buttons):
+                raise ConfigurationError("A combo needs a list of buttons, not {}".format(buttons))
+            if frozenset(buttons) in masks:
+                raise ConfigurationError("Another combo uses the buttons {}".format(buttons))
+            masks.add(frozenset(buttons))
+            effects = combo_dict.get("effects")
+            if not isinstance(effects, list):
+                raise ConfigurationError("A combo needs a list of effects, not {}".format(effects))
+            compiled.append({"buttons": sorted(set(buttons)), "effects": map(compile_effect, effects)})
+        except ConfigurationError as e:
+            raise ConfigurationError("Combo {}: {}".format(n, e))
+    button_bits, table = make_combo_table(range(len(compiled)), lambda n: compiled[n]["buttons"])
+    return compiled, button_bits, table
+
+
+# Configurations loaded by this process by path, with the modification time and size of the file they were loaded from
+loaded_configurations = {}
+
+
+def load_configuration(filename):
+    """
+    Load a compiled effects configuration. The compiled form is kept next to the JSON file so that the JSON only has
+    to be parsed and checked again when it changes.
+    :param filename: The path of a JSON configuration file
+    :return: A compiled configuration (see compile_configuration)
+    :raises ConfigurationError: If the configuration could not be played
+    """
+    stat = os.stat(filename)
+    key = (COMPILED_VERSION, stat.st_mtime, stat.st_size, sorted(effect_names()))
+    loaded = loaded_configurations.get(filename)
+    if loaded is not None and loaded[0] == key:
+        return loaded[1]
+    compiled_path = filename + COMPILED_EXTENSION
+    configuration = None
+    try:
+        with open(compiled_path, "rb") as f:
+            cached_key, cached_configuration = pickle.load(f)
+        if cached_key == key:
+            configuration = cached_configuration
+    except (IOError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+        pass
+    if configuration is None:
+        with open(filename) as f:
+            try:
+                combo_dicts = json.load(f)
+            except ValueError as e:
+                raise ConfigurationError("{} is not valid JSON: {}".format(filename, e))
+        try:
+            configuration = compile_configuration(combo_dicts)
+        except ConfigurationError as e:
+            raise ConfigurationError("{}: {}".format(filename, e))
+        try:
+            with open(compiled_path, "wb") as f:
+                pickle.dump((key, configuration), f, pickle.HIGHEST_PROTOCOL)
+        except IOError as e:
+            logger.warning("Could not cache compiled configuration {}: {}".format(compiled_path, e))
+    loaded_configurations[filename] = (key, configuration)
+    return configuration
+
+
 class Combinator(object):
     """Interprets a JSON dancemat effects configuration and applies effects corresponding to button combinations"""
 
@@ -37,15 +208,14 @@ class Combinator(object):
         If no arguments are passed this combinator can be used to generate a JSON template by adding combos
         """
         if filename is not None and track is not None:
-            self.__current_combos = []
-            with open(filename) as f:
-                self.combos = map(lambda d: Combo(track, d), json.loads(f.read()))
-
-                for combo in self.combos:
-                    combo.start()
-                self.button_map = {sum(map(hash, combo.buttons)): combo for combo in self.combos}
+            combo_dicts, self.button_bits, table = load_configuration(filename)
+            self.combos = [Combo(track, combo_dict) for combo_dict in combo_dicts]
+            self.combo_table = [tuple(self.combos[n] for n in entry) for entry in table]
+            for combo in self.combos:
+                combo.start()
         else:
             self.combos = []
+            self.button_bits, self.combo_table = make_combo_table(self.combos)
 
     def apply_for_buttons(self, buttons):
         """
@@ -53,9 +223,11 @@ class Combinator(object):
         buttons that combo will be applied. Otherwise, effects for each individual buttons will be stacked.
         :param buttons: A list of buttons
         """
-        buttons_hash = sum(map(hash, buttons))
-        if buttons_hash in self.button_map:
-            self.button_map[buttons_hash].play()
+        mask = 0
+        for button in buttons:
+            mask |= self.button_bits.get(button, 0)
+        for combo in self.combo_table[mask]:
+            combo.play()
 
     def dict(self):
         return map(Combo.dict, self.combos)
@@ -116,20 +288,49 @@ class Combo(object):
         return self.__repr__()
 
 
-class Effect(Thread):
-    """An individual effect that can be applied to change the music"""
+class Effect(object):
+    """
+    An individual effect that can be applied to change the music. Playing an effect applies it straight away and a
+    timer removes it once length seconds have passed without it being played again.
+    """
+
+    # The (lowest, highest) number that the value of the effect can be or None if any value can be played
+    value_range = None
 
-    def __init__(self, effect_dict):
+    @classmethod
+    def compile_value(cls, value):
+        """
+        Check the value of an effect of this class
+        :param value: The value from an effect dictionary
+        :return: The value to play
+        :raises ConfigurationError: If the value could not be played
+        """
+        if cls.value_range is not None:
+            lowest, highest = cls.value_range
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not lowest <= value <= highest:
+                raise ConfigurationError("The value of {} must be a number from {} to {}, not {}".format(
+                    convert(cls.__name__), lowest, highest, value))
+        return value
+
+    def __init__(self, effect_dict, timers=timers.shared_timers):
         """
 
         :param effect_dict: A dictionary describing this effect.
+        :param timers: The timers that remove the effect (see timers)
         """
-        super(Effect, self).__init__()
+        self.timers = timers
         self.name = effect_dict["name"]
         self.value = effect_dict["value"] if "value" in effect_dict else 0
         self.length = (effect_dict["length"] if "length" in effect_dict else EFFECT_LENGTH)
+        # How long continuous changes such as pitch bends take to apply and to remove
+        self.ramp = effect_dict["ramp"] if "ramp" in effect_dict else audio.RAMP_SECONDS
         self.is_started = False
-        self.queue = Queue()
+        self.is_applied = False
+        self.lock = Lock()
+        # Counts plays so that a removal timer can tell whether the effect has been played again since it was set
+        self.plays = 0
+        # The timer that will remove the effect
+        self.removal = None
 
     @classmethod
     def from_dict(cls, track, effect_dict):
@@ -139,12 +340,10 @@ class Effect(Thread):
         :param effect_dict: A dictionary describing an effect.
         """
         name = effect_dict["name"]
-        print Effect.classes
-
         try:
             effect_class = Effect.classes[name]
         except KeyError:
-            raise AssertionError("No effect named {}".format(name))
+            raise ConfigurationError("No effect named {}".format(name))
         return effect_class(track, effect_dict)
 
     def apply(self):
@@ -153,31 +352,44 @@ class Effect(Thread):
     def remove(self):
         raise AssertionError("{}.default not overridden".format(self.name))
 
+    def start(self):
+        """Allow the effect to be played"""
+        self.is_started = True
+
     def play(self):
-        self.queue.put("play")
+        """Apply the effect if it is not already applied and (re)start the countdown to removing it"""
+        with self.lock:
+            if not self.is_started:
+                return
+            if self.removal is not None:
+                self.removal.cancel()
+            if not self.is_applied:
+                self.is_applied = True
+                self.apply()
+            self.plays += 1
+            self.removal = self.timers.call_later(self.length, partial(self.expire, self.plays))
+
+    def expire(self, plays):
+        """
+        Remove the effect if it has not been played again since a removal timer was set
+        :param plays: The number of plays when the timer was set
+        """
+        with self.lock:
+            if plays == self.plays and self.is_applied:
+                self.removal = None
+                self.is_applied = False
+                self.remove()
 
     def stop(self):
-        self.queue.put("stop")
-
-    def run(self):
-        is_applied = False
-        time = 0.
-        while True:
-            if not self.queue.empty():
-                message = self.queue.get()
-                if message == "play":
-                    time = 0.
-                    if not is_applied:
-                        is_applied = True
-                        self.apply()
-                elif message == "stop":
-                    break
-            if time >= self.length and is_applied:
-                is_applied = False
+        """Stop the effect from being played again, removing it if it is applied"""
+        with self.lock:
+            self.is_started = False
+            if self.removal is not None:
+                self.removal.cancel()
+                self.removal = None
+            if self.is_applied:
+                self.is_applied = False
                 self.remove()
-            if time <= self.length:
-                time += INTERVAL
-            sleep(INTERVAL)
 
     def dict(self):
         return {"name": self.name, "value": self.value}
@@ -199,7 +411,7 @@ class ChannelEffect(Effect):
         :param effect_dict: An effect dictionary that includes one or more channels or instrument types
         (see player.InstrumentType)
         """
-        super(ChannelEffect, self).__init__(effect_dict)
+        super(ChannelEffect, self).__init__(effect_dict, track.timers)
         self.instrument_types = None
         self.instrument_group = None
         self.__channels = None
@@ -210,17 +422,13 @@ class ChannelEffect(Effect):
             self.instrument_types = effect_dict["instrument_types"]
         if "instrument_group" in effect_dict:
             self.instrument_group = effect_dict["instrument_group"]
+        instrument_types = list(self.instrument_types or [])
+        if self.instrument_group is not None:
+            instrument_types.extend(audio.InstrumentGroup.with_name(self.instrument_group))
         if all(map(lambda p: p is None, [self.__channels, self.instrument_types, self.instrument_group])):
-            self.channels = self.track.channels_with_instrument_group("all")
-        else:
-            self.channels = []
-            if self.__channels is not None:
-                self.channels.extend([channel for channel in self.track.channels if channel.number in self.__channels])
-            if self.instrument_types is not None:
-                for instrument_type in self.instrument_types:
-                    self.channels.extend(self.track.channels_with_instrument_type(instrument_type))
-            if self.instrument_group is not None:
-                self.channels.extend(self.track.channels_with_instrument_group(self.instrument_group))
+            instrument_types = audio.InstrumentGroup.with_name("all")
+        # Follows program changes so that the effect always acts on the channels that currently match
+        self.channels = audio.ChannelView(self.track, self.__channels or (), instrument_types)
 
     @property
     def dict(self):
@@ -237,30 +445,40 @@ class ChannelEffect(Effect):
 class PitchBend(ChannelEffect):
     """Bends the pitch of one or more channels"""
 
+    value_range = (audio.PITCHWHEEL_MIN, audio.PITCHWHEEL_MAX)
+
     def apply(self):
         for channel in self.channels:
-            channel.pitch_bend(self.value)
+            channel.pitch_bend(self.value, self.ramp)
 
     def remove(self):
         for channel in self.channels:
-            channel.pitch_bend(audio.PITCHWHEEL_DEFAULT)
+            channel.pitch_bend(audio.PITCHWHEEL_DEFAULT, self.ramp)
 
 
 class VolumeChange(ChannelEffect):
     """Changes the volume of one or more channels"""
 
+    value_range = (audio.VOLUME_MIN, audio.VOLUME_MAX)
+
     def apply(self):
         for channel in self.channels:
-            channel.volume = self.value
+            channel.ramp("volume", self.value, self.ramp)
 
     def remove(self):
         for channel in self.channels:
-            channel.volume = audio.VOLUME_DEFAULT
+            channel.ramp("volume", audio.VOLUME_DEFAULT, self.ramp)
 
 
 class Intervals(ChannelEffect):
     """Converts notes played through a channel into one or more relative intervals in the key"""
 
+    @classmethod
+    def compile_value(cls, value):
+        if not isinstance(value, list) or not all(isinstance(interval, int) for interval in value):
+            raise ConfigurationError("The value of intervals must be a list of intervals, not {}".format(value))
+        return value
+
     def apply(self):
         for channel in self.channels:
             channel.intervals = self.value
@@ -273,46 +491,71 @@ class Intervals(ChannelEffect):
 class InstrumentType(ChannelEffect):
     """Changes the type of instrument of one or more channels. See player.InstrumentType"""
 
+    @classmethod
+    def compile_value(cls, value):
+        if isinstance(value, basestring):
+            if value not in audio.InstrumentType.instrument_type_dict:
+                raise ConfigurationError("No instrument type named {}".format(value))
+            return audio.InstrumentType.with_name(value)
+        if not (isinstance(value, int) and 0 <= value < 16):
+            raise ConfigurationError("The value of instrument_type must be a name or a number from 0 to 15, not {}"
+                                     .format(value))
+        return value
+
     def __init__(self, track, effect_dict):
         super(InstrumentType, self).__init__(track, effect_dict)
-        self.defaults = [channel.instrument_type for channel in self.channels]
+        # (channel, instrument type) for each channel changed when the effect was applied
+        self.defaults = []
 
     def apply(self):
-        for channel in self.channels:
+        # Taken before the change as the change moves the channels out of the view
+        self.defaults = [(channel, channel.instrument_type) for channel in self.channels]
+        for channel, _ in self.defaults:
             channel.instrument_type = self.value
 
     def remove(self):
-        for n, channel in enumerate(self.channels):
-            channel.instrument_type = self.defaults[n]
+        for channel, instrument_type in self.defaults:
+            channel.instrument_type = instrument_type
 
 
 class InstrumentVersion(ChannelEffect):
     """Changes the version of the instrument for one or more channels. e.g. from one piano to a different piano"""
 
+    @classmethod
+    def compile_value(cls, value):
+        if not (isinstance(value, int) and 0 <= value < 8):
+            raise ConfigurationError("The value of instrument_version must be a number from 0 to 7, not {}".format(
+                value))
+        return value
+
     def __init__(self, track, effect_dict):
         super(InstrumentVersion, self).__init__(track, effect_dict)
-        self.defaults = [channel.instrument_version for channel in self.channels]
+        # (channel, instrument version) for each channel changed when the effect was applied
+        self.defaults = []
 
     def apply(self):
-        for channel in self.channels:
+        self.defaults = [(channel, channel.instrument_version) for channel in self.channels]
+        for channel, _ in self.defaults:
             channel.instrument_version = self.value
 
     def remove(self):
-        for n, channel in enumerate(self.channels):
-            channel.instrument_version = self.defaults[n]
+        for channel, instrument_version in self.defaults:
+            channel.instrument_version = instrument_version
 
 
 class TrackEffect(Effect):
     """An effect that is applied to the whole track"""
 
     def __init__(self, track, effect_dict):
-        super(TrackEffect, self).__init__(effect_dict)
+        super(TrackEffect, self).__init__(effect_dict, track.timers)
         self.track = track
 
 
 class TempoShift(TrackEffect):
     """Shifts the tempo of the whole track by some factor. 0.5 is half tempo and 2 double tempo"""
 
+    value_range = (audio.TEMPO_SHIFT_MIN, audio.TEMPO_SHIFT_MAX)
+
     def apply(self):
         self.track.tempo_shift = self.value
 
@@ -321,23 +564,27 @@ class TempoShift(TrackEffect):
 
 
 class Modulation(ChannelEffect):
+    value_range = (0, 127)
+
     def apply(self):
         for channel in self.channels:
-            channel.modulation = self.value
+            channel.ramp("modulation", self.value, self.ramp)
 
     def remove(self):
         for channel in self.channels:
-            channel.modulation = 0
+            channel.ramp("modulation", 0, self.ramp)
 
 
 class Pan(ChannelEffect):
+    value_range = (0, 127)
+
     def apply(self):
         for channel in self.channels:
-            channel.pan = self.value
+            channel.ramp("pan", self.value, self.ramp)
 
     def remove(self):
         for channel in self.channels:
-            channel.pan = 63
+            channel.ramp("pan", 63, self.ramp)
 
 
 class ChannelSwitch(ChannelEffect):
@@ -384,3 +631,45 @@ class TestEffect(object):
 
     def test_convert(self):
         assert convert("ChannelSwitch") == "channel_switch"
+
+    def test_combo_table(self):
+        up, down, both, x = Combo(), Combo(), Combo(), Combo()
+        up.buttons, down.buttons, both.buttons, x.buttons = ["up"], ["down"], ["up", "down"], ["x"]
+        button_bits, table = make_combo_table([up, down, both, x])
+        assert len(table) == 8
+        assert table[0] == ()
+        assert table[button_bits["up"]] == (up,)
+        assert table[button_bits["up"] | button_bits["down"]] == (both,)
+        assert set(table[button_bits["up"] | button_bits["x"]]) == {up, x}
+
+    def test_compile_configuration(self):
+        combos, button_bits, table = compile_configuration([
+            {"buttons": ["up"], "effects": [{"name": "pitch_bend", "value": 5000, "channels": [2, 0, 2]}]},
+            {"buttons": ["x"], "effects": [{"name": "intervals", "value": [2], "instrument_types": ["piano", 4]}]}])
+        assert combos[0]["effects"][0]["channels"] == [0, 2]
+        assert combos[1]["effects"][0]["instrument_types"] == [0, 4]
+        assert compile_effect({"name": "instrument_type", "value": "strings"})["value"] == 5
+        assert set(table[button_bits["up"] | button_bits["x"]]) == {0, 1}
+
+    def test_shipped_configurations(self):
+        directory = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "configurations")
+        for name in os.listdir(directory):
+            if name.endswith(".json"):
+                with open(os.path.join(directory, name)) as f:
+                    compile_configuration(json.load(f))
+
+    def test_bad_configuration(self):
+        for combo_dicts in ([{"buttons": ["up"], "effects": [{"name": "channel_effect"}]}],
+                            [{"buttons": ["up"], "effects": [{"name": "pan", "channels": [16]}]}],
+                            [{"buttons": ["up"], "effects": []}, {"buttons": ["up"], "effects": []}],
+                            [{"buttons": [], "effects": []}],
+                            [{"buttons": ["up"], "effects": [{"name": "instrument_type", "value": "pianoo"}]}],
+                            [{"buttons": ["up"], "effects": [{"name": "intervals", "value": "x"}]}],
+                            [{"buttons": ["up"], "effects": [{"name": "tempo_shift", "value": 0}]}],
+                            [{"buttons": ["up"], "effects": [{"name": "tempo_shift"}]}],
+                            [{"buttons": ["up"], "effects": [{"name": "volume_change", "value": 2}]}]):
+            try:
+                compile_configuration(combo_dicts)
+            except ConfigurationError:
+                continue
+            assert False, "{} compiled".format(combo_dicts)
@@ -0,0 +1,135 @@
+import unittest
+from collections import namedtuple
+from operator import itemgetter
+
+import mido
+
+# Message types by status nibble
+TYPES = {0x80: "note_off",
+         0x90: "note_on",
+         0xA0: "polytouch",
+         0xB0: "control_change",
+         0xC0: "program_change",
+         0xD0: "aftertouch",
+         0xE0: "pitchwheel"}
+
+STATUSES = {message_type: status for status, message_type in TYPES.items()}
+
+# The names mido gives the data bytes of each message type
+FIELDS = {"note_off": ("note", "velocity"),
+          "note_on": ("note", "velocity"),
+          "polytouch": ("note", "value"),
+          "control_change": ("control", "value"),
+          "program_change": ("program",),
+          "aftertouch": ("value",),
+          "pitchwheel": ()}
+
+# Offset of pitchwheel values, which mido gives from -8192 to 8191
+PITCH_OFFSET = 8192
+
+
+class Event(namedtuple("Event", ("type", "channel", "data1", "data2"))):
+    """
+    An immutable channel message. Events are passed between the timeline, channels and games in place of mido
+    messages so that nothing can change a message that something else holds, and are only converted to mido messages
+    by the output ports. The data bytes can also be read by the names mido uses (e.g. note and velocity).
+    """
+
+    __slots__ = ()
+
+    note = property(itemgetter(2))
+    velocity = property(itemgetter(3))
+    control = property(itemgetter(2))
+    program = property(itemgetter(2))
+
+    @property
+    def value(self):
+        return self.data1 if self.type == "aftertouch" else self.data2
+
+    @property
+    def pitch(self):
+        return (self.data1 | self.data2 << 7) - PITCH_OFFSET
+
+    @classmethod
+    def make(cls, type, channel=0, **values):
+        """
+        :param type: The mido name of the message type (e.g. "note_on")
+        :param channel: The channel number
+        :param values: Values by the names mido uses (e.g. note=60, velocity=64)
+        :return: An Event
+        """
+        return cls(type, channel, 0, 0).replace(**values)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        :param data: The raw bytes of a channel message
+        :return: An Event
+        """
+        return cls(TYPES[data[0] & 0xF0], data[0] & 0x0F, data[1] if len(data) > 1 else 0,
+                   data[2] if len(data) > 2 else 0)
+
+    @classmethod
+    def from_message(cls, msg):
+        """
+        :param msg: A mido channel message
+        :return: An Event
+        """
+        return cls.from_bytes(msg.bytes())
+
+    def replace(self, **changes):
+        """
+        :param changes: New values by field name (type, channel, data1, data2) or by the names mido uses
+        :return: A new Event
+        """
+        fields = FIELDS[changes.get("type", self.type)]
+        for name in list(changes):
+            if name in fields:
+                changes["data{}".format(fields.index(name) + 1)] = changes.pop(name)
+            elif name == "pitch":
+                value = changes.pop(name) + PITCH_OFFSET
+                changes["data1"] = value & 0x7F
+                changes["data2"] = value >> 7
+        return self._replace(**changes)
+
+    def bytes(self):
+        """
+        :return: The raw bytes of the message
+        """
+        status = STATUSES[self.type] | self.channel
+        if len(FIELDS[self.type]) == 1:
+            return [status, self.data1]
+        return [status, self.data1, self.data2]
+
+    def to_message(self):
+        """
+        :return: A new mido message
+        """
+        return mido.Message.from_bytes(self.bytes())
+
+
+class EventTestCase(unittest.TestCase):
+    def test_names(self):
+        event = Event.make("note_on", channel=2, note=60, velocity=100)
+        self.assertEqual(("note_on", 2, 60, 100), event)
+        self.assertEqual(60, event.note)
+        self.assertEqual(100, event.velocity)
+
+    def test_replace(self):
+        event = Event.make("note_on", note=60, velocity=100)
+        quieter = event.replace(velocity=50, channel=3)
+        self.assertEqual(100, event.velocity)
+        self.assertEqual(("note_on", 3, 60, 50), quieter)
+
+    def test_bytes(self):
+        self.assertEqual([0xC1, 33], Event.make("program_change", channel=1, program=33).bytes())
+        self.assertEqual(Event.make("control_change", control=7, value=90),
+                         Event.from_bytes([0xB0, 7, 90]))
+
+    def test_pitch(self):
+        for pitch in (-8192, 0, 100, 8191):
+            self.assertEqual(pitch, Event.make("pitchwheel", pitch=pitch).pitch)
+
+
+if __name__ == "__main__":
+    unittest.main()
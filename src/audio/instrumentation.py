@@ -0,0 +1,198 @@
+import json
+import logging
+import unittest
+from threading import Lock, local
+
+logger = logging.getLogger(__name__)
+
+# Bucket n counts durations of less than 2 ** n microseconds (and at least 2 ** (n - 1)). The last bucket also
+# counts anything longer.
+BUCKETS = 25
+
+
+class Histogram(object):
+    """Counts durations in a fixed number of exponentially sized buckets"""
+
+    def __init__(self, buckets=BUCKETS):
+        """
+
+        :param buckets: The number of buckets
+        """
+        self.counts = [0] * buckets
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, seconds):
+        """
+        Count a duration
+        :param seconds: The duration in seconds. Negative durations are counted in the first bucket.
+        """
+        microseconds = int(seconds * 1e6)
+        index = min(microseconds.bit_length(), len(self.counts) - 1) if microseconds > 0 else 0
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        """
+        :param fraction: A fraction between 0 and 1 (e.g. 0.99)
+        :return: The upper bound in seconds of the bucket containing that fraction of durations
+        """
+        target = fraction * self.count
+        running = 0
+        for index, count in enumerate(self.counts):
+            running += count
+            if running >= target:
+                return (1 << index) / 1e6
+        return self.max
+
+    def dict(self):
+        return {"count": self.count,
+                "mean": self.total / self.count if self.count > 0 else 0.,
+                "max": self.max,
+                "p50": self.percentile(0.5),
+                "p99": self.percentile(0.99),
+                "counts": self.counts}
+
+
+class Recorder(object):
+    """
+    Records how late the audio thread dispatches messages and how long they take to get through each port.
+
+    Per channel:
+        dispatch - from the time a message was scheduled to the time the track took it from the timeline
+        latency - from the time a message was scheduled to the time it had been sent
+    Per port:
+        queue - from the time a message was queued to the time the sender thread took it
+        send - how long the underlying port took to send it
+        latency - from the time a message was scheduled to the time it had been sent
+    """
+
+    def __init__(self, enabled=False):
+        """
+
+        :param enabled: Nothing is recorded unless this is True
+        """
+        self.enabled = enabled
+        self.histograms = {}
+        self.lock = Lock()
+        # Holds the time at which the message currently being dispatched on each thread was scheduled
+        self.context = local()
+
+    def histogram(self, group, name, measure):
+        """
+        :param group: "channel" or "port"
+        :param name: The channel number or port name
+        :param measure: The name of the measurement (see above)
+        :return: The Histogram for that measurement, created if needed
+        """
+        key = (group, name, measure)
+        try:
+            return self.histograms[key]
+        except KeyError:
+            with self.lock:
+                return self.histograms.setdefault(key, Histogram())
+
+    @property
+    def scheduled(self):
+        """The time at which the message being dispatched by this thread was scheduled or None"""
+        return getattr(self.context, "scheduled", None)
+
+    def record_dispatch(self, channel, scheduled, dispatched):
+        """
+        Record a message being taken from a timeline. Messages sent by this thread until end_dispatch is called are
+        treated as scheduled at the same time.
+        :param channel: The channel number of the message
+        :param scheduled: When the message should have been dispatched
+        :param dispatched: When it was dispatched
+        """
+        self.context.scheduled = scheduled
+        self.histogram("channel", channel, "dispatch").add(dispatched - scheduled)
+
+    def end_dispatch(self):
+        """Record that this thread has finished dispatching, so that what it sends next is timed from when it is
+        queued"""
+        self.context.scheduled = None
+
+    def record_send(self, port, channel, scheduled, queued, dequeued, sent):
+        """
+        Record a message being sent through a port
+        :param port: The name of the port
+        :param channel: The channel number of the message or None
+        :param scheduled: When the message should have been played
+        :param queued: When it was queued for the port
+        :param dequeued: When the sender thread took it from the queue
+        :param sent: When the underlying port finished sending it
+        """
+        self.histogram("port", port, "queue").add(dequeued - queued)
+        self.histogram("port", port, "send").add(sent - dequeued)
+        self.histogram("port", port, "latency").add(sent - scheduled)
+        if channel is not None:
+            self.histogram("channel", channel, "latency").add(sent - scheduled)
+
+    def summary(self):
+        """
+        :return: A nested dictionary of {group: {name: {measure: histogram}}}
+        """
+        summary = {}
+        with self.lock:
+            items = list(self.histograms.items())
+        for (group, name, measure), histogram in items:
+            summary.setdefault(group, {}).setdefault(str(name), {})[measure] = histogram.dict()
+        return summary
+
+    def dump(self, path):
+        """
+        Write a summary to a json file
+        :param path: The path of the file
+        """
+        try:
+            with open(path, "w") as f:
+                json.dump(self.summary(), f, indent=2, sort_keys=True)
+        except IOError as e:
+            logger.warning("Could not write instrumentation to {}: {}".format(path, e))
+
+
+recorder = Recorder()
+
+
+class HistogramTestCase(unittest.TestCase):
+    def test_buckets(self):
+        histogram = Histogram()
+        histogram.add(0.)
+        histogram.add(0.000003)
+        histogram.add(0.001)
+        histogram.add(100.)
+        self.assertEqual(1, histogram.counts[0])
+        self.assertEqual(1, histogram.counts[2])
+        self.assertEqual(1, histogram.counts[10])
+        self.assertEqual(1, histogram.counts[-1])
+        self.assertEqual(100., histogram.max)
+
+    def test_percentile(self):
+        histogram = Histogram()
+        for _ in range(99):
+            histogram.add(0.000003)
+        histogram.add(0.001)
+        self.assertEqual(0.000004, histogram.percentile(0.5))
+        self.assertEqual(0.000004, histogram.percentile(0.99))
+        self.assertEqual(0.001024, histogram.percentile(1.))
+
+
+class RecorderTestCase(unittest.TestCase):
+    def test_summary(self):
+        recorder = Recorder(enabled=True)
+        recorder.record_dispatch(3, 1., 1.001)
+        recorder.record_send("keys", 3, recorder.scheduled, 1.001, 1.002, 1.004)
+        summary = recorder.summary()
+        self.assertEqual(1, summary["channel"]["3"]["dispatch"]["count"])
+        self.assertAlmostEqual(0.004, summary["channel"]["3"]["latency"]["max"])
+        self.assertAlmostEqual(0.002, summary["port"]["keys"]["send"]["max"])
+        recorder.end_dispatch()
+        self.assertIsNone(recorder.scheduled)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,303 @@
+import logging
+import unittest
+from threading import Thread, Lock
+
+from clock import wall_clock, VirtualClock
+
+logger = logging.getLogger(__name__)
+
+# Longest time the mixer sleeps for while playing so that new tracks, tempo changes and envelopes are picked up
+MAX_SLEEP = 0.05
+# How often the gain of a track with an envelope is updated
+ENVELOPE_STEP = 0.05
+
+
+class Envelope(object):
+    """A linear change in the gain of a track over time"""
+
+    def __init__(self, start_time, seconds, start_gain, end_gain, stops_track=False):
+        """
+
+        :param start_time: The time at which the change starts
+        :param seconds: How long the change takes
+        :param start_gain: The gain at the start
+        :param end_gain: The gain at the end
+        :param stops_track: Should the track be stopped when the change is finished?
+        """
+        self.start_time = start_time
+        self.seconds = seconds
+        self.start_gain = start_gain
+        self.end_gain = end_gain
+        self.stops_track = stops_track
+        self.last_update = None
+
+    def gain_at(self, time):
+        """
+        :param time: A time
+        :return: The gain at that time
+        """
+        if self.seconds <= 0:
+            return self.end_gain
+        fraction = min(max((time - self.start_time) / self.seconds, 0.), 1.)
+        return self.start_gain + fraction * (self.end_gain - self.start_gain)
+
+    def is_finished_at(self, time):
+        return time >= self.start_time + self.seconds
+
+
+class Mixer(Thread):
+    """
+    Plays any number of tracks from one thread. The timelines of the tracks are merged so that events are played in
+    deadline order, with the events of higher priority tracks going first when several are due at once (e.g. when
+    playback has fallen behind). Each track has a gain which envelopes can change over time to fade or crossfade
+    tracks.
+    """
+
+    def __init__(self, clock=wall_clock):
+        """
+
+        :param clock: The clock that the mixer sleeps on. Tracks played by the mixer should use the same clock.
+        """
+        super(Mixer, self).__init__(name="mixer")
+        self.daemon = True
+        self.clock = clock
+        self.lock = Lock()
+        # Notified when a track is added so that the mixer can wait while it has nothing to play
+        self.condition = clock.new_condition()
+        # Tracks that have been added but not yet begun
+        self.pending = []
+        # Tracks that are playing
+        self.tracks = []
+        # Envelopes by track
+        self.envelopes = {}
+        # Tracks to start once another track has finished, by the track they are waiting for
+        self.successors = {}
+        self.__is_started = False
+
+    def add(self, track):
+        """
+        Start playing a track. Its gain and priority are taken from the track.
+        :param track: A Track that has not been started
+        """
+        with self.lock:
+            self.pending.append(track)
+            if not self.__is_started:
+                self.__is_started = True
+                self.clock.register(self)
+                self.start()
+        with self.condition:
+            self.clock.notify(self.condition)
+
+    def fade(self, track, gain, seconds, stops_track=False):
+        """
+        Change the gain of a track gradually
+        :param track: A playing Track
+        :param gain: The gain to end at
+        :param seconds: How long the change should take
+        :param stops_track: Should the track be stopped once the change is finished?
+        """
+        with self.lock:
+            self.envelopes[track] = Envelope(self.clock.now(), seconds, track.gain, gain, stops_track)
+
+    def crossfade(self, outgoing, incoming, seconds):
+        """
+        Fade one track out while fading another in, stopping the first track at the end. Tracks that share channels
+        would change each other's programs and controllers, so then the incoming track starts once the outgoing track
+        has faded out and finished instead, and starting it in the meantime does nothing.
+        :param outgoing: A playing Track
+        :param incoming: A Track that has not been started
+        :param seconds: How long the crossfade should take
+        """
+        with self.lock:
+            is_waiting = outgoing.is_playing and bool(outgoing.channel_numbers & incoming.channel_numbers)
+            if is_waiting:
+                self.successors[outgoing] = incoming
+                # Holds back the incoming track as a hand off does
+                incoming.previous_track = outgoing
+        if is_waiting:
+            self.fade(outgoing, 0., seconds, stops_track=True)
+            return
+        if not outgoing.is_playing:
+            incoming.start()
+            return
+        # Each track must only stop its own notes as the other track is sounding on the same channels
+        incoming.clears_notes_on_start = False
+        outgoing.clears_notes_on_stop = False
+        incoming.gain = 0.
+        incoming.start()
+        self.fade(incoming, 1., seconds)
+        self.fade(outgoing, 0., seconds, stops_track=True)
+
+    def update_envelopes(self, now):
+        """
+        Set the gain of each track with an envelope
+        :param now: The current time
+        """
+        with self.lock:
+            envelopes = self.envelopes.items()
+        for track, envelope in envelopes:
+            is_finished = envelope.is_finished_at(now)
+            if is_finished or envelope.last_update is None or now - envelope.last_update >= ENVELOPE_STEP:
+                envelope.last_update = now
+                track.gain = envelope.gain_at(now)
+            if is_finished:
+                with self.lock:
+                    if self.envelopes.get(track) is envelope:
+                        del self.envelopes[track]
+                if envelope.stops_track:
+                    track.stop()
+
+    def next_track(self, now):
+        """
+        :param now: The current time
+        :return: (the track to step or None, the time at which the next track is due)
+        """
+        due = None
+        next_deadline = None
+        for track in self.tracks:
+            position = track.next_position()
+            deadline = now if position is None else track.scheduler.deadline(position)
+            if deadline <= now:
+                if due is None or track.priority > due.priority:
+                    due = track
+            elif next_deadline is None or deadline < next_deadline:
+                next_deadline = deadline
+        return due, next_deadline
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.tracks and not self.pending:
+                    self.clock.wait(self.condition, None)
+            with self.lock:
+                pending, self.pending = self.pending, []
+            for track in pending:
+                track.begin()
+                self.tracks.append(track)
+
+            now = self.clock.now()
+            self.update_envelopes(now)
+            track, next_deadline = self.next_track(now)
+            if track is None:
+                self.clock.sleep(MAX_SLEEP if next_deadline is None else min(next_deadline - now, MAX_SLEEP))
+                continue
+            try:
+                is_playing = track.advance()
+            except Exception as e:
+                logger.exception(e)
+                is_playing = False
+            if not is_playing:
+                self.tracks.remove(track)
+                with self.lock:
+                    self.envelopes.pop(track, None)
+                track.finish()
+                with self.lock:
+                    successor = self.successors.pop(track, None)
+                # The successor may have been handed off to another track while it waited
+                if successor is not None and successor.previous_track is track:
+                    successor.previous_track = None
+                    successor.start()
+
+
+class MockScheduler(object):
+    def __init__(self, clock):
+        self.clock = clock
+
+    def deadline(self, position):
+        return position
+
+
+class MockTrack(object):
+    def __init__(self, clock, times, priority=0, played=None):
+        self.scheduler = MockScheduler(clock)
+        self.times = times
+        self.priority = priority
+        self.played = played
+        self.gain = 1.
+        self.index = 0
+        self.is_finished = False
+
+    def begin(self):
+        pass
+
+    def next_position(self):
+        return self.times[self.index] if self.index < len(self.times) else None
+
+    def advance(self):
+        if self.index == len(self.times):
+            return False
+        self.played.append((self, self.times[self.index]))
+        self.index += 1
+        return True
+
+    def stop(self):
+        self.index = len(self.times)
+
+    def finish(self):
+        self.is_finished = True
+
+
+class MixerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock()
+        self.mixer = Mixer(self.clock)
+        self.played = []
+
+    def step(self, times):
+        for _ in range(times):
+            if not self.mixer.tracks:
+                break
+            now = self.clock.now()
+            self.mixer.update_envelopes(now)
+            track, next_deadline = self.mixer.next_track(now)
+            if track is None:
+                self.clock.advance(next_deadline - now)
+            elif not track.advance():
+                self.mixer.tracks.remove(track)
+                track.finish()
+
+    def test_merge(self):
+        first = MockTrack(self.clock, [0., 1., 3.], played=self.played)
+        second = MockTrack(self.clock, [0.5, 2.], played=self.played)
+        self.mixer.tracks = [first, second]
+        self.step(12)
+        self.assertEqual([0., 0.5, 1., 2., 3.], [time for _, time in self.played])
+        self.assertTrue(first.is_finished)
+        self.assertTrue(second.is_finished)
+
+    def test_priority(self):
+        low = MockTrack(self.clock, [0.], played=self.played)
+        high = MockTrack(self.clock, [0.], priority=1, played=self.played)
+        self.mixer.tracks = [low, high]
+        self.step(10)
+        self.assertEqual([high, low], [track for track, _ in self.played])
+
+    def test_idle(self):
+        clock = VirtualClock(free_running=True)
+        mixer = Mixer(clock)
+        tracks = [MockTrack(clock, [1.], played=self.played), MockTrack(clock, [2.], played=self.played)]
+        for track in tracks:
+            mixer.add(track)
+            for _ in range(1000):
+                if track.is_finished and mixer in clock.waiting:
+                    break
+                mixer.join(0.001)
+            # Waits for another track rather than sleeping, which would move the clock on
+            self.assertIn(mixer, clock.waiting)
+            self.assertAlmostEqual(track.times[0], clock.now())
+
+    def test_fade(self):
+        track = MockTrack(self.clock, [0., 1., 2., 3.], played=self.played)
+        self.mixer.tracks = [track]
+        self.mixer.fade(track, 0., 2., stops_track=True)
+        self.step(2)
+        self.mixer.update_envelopes(self.clock.now())
+        self.assertAlmostEqual(0.5, track.gain)
+        self.clock.advance(1.)
+        self.step(2)
+        self.assertEqual(0., track.gain)
+        self.assertTrue(track.is_finished)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,4 @@
 import unittest
-from Queue import Queue
 
 
 class Key(object):
@@ -91,6 +90,56 @@ for k in Key.all():
     for pos in scale_array[k].all_positions:
         keys_array[pos].add(k)
 
+# The keys containing each midi position as a 12 bit mask with bit k set for key k
+key_masks = [sum(1 << k for k in keys) for keys in keys_array]
+
+
+class HarmonyTable(object):
+    """
+    The notes produced by applying a fixed set of scale intervals to every midi note, for each key. Each key's
+    row is built the first time it is needed.
+    """
+
+    def __init__(self, intervals, scale=Scale.major):
+        """
+
+        :param intervals: A series of intervals within the scale. For example, [0, 2, 4] would give a triad
+        :param scale: The scale the intervals are counted in (e.g. Scale.major)
+        """
+        self.intervals = tuple(intervals)
+        self.scale = scale
+        self.__rows = {}
+
+    def row(self, key):
+        """
+
+        :param key: A key (see Key)
+        :return: A list indexed by midi note of tuples giving the notes of each chord. Notes that are not in the
+        scale for the key map to None.
+        """
+        try:
+            return self.__rows[key]
+        except KeyError:
+            row = self.__rows[key] = self.__build_row(key)
+            return row
+
+    def chord(self, key, note):
+        """
+
+        :param key: A key (see Key)
+        :param note: A midi note
+        :return: A tuple of midi notes or None if the note is not in the scale for the key
+        """
+        return self.row(key)[note]
+
+    def __build_row(self, key):
+        positions = Scale(self.scale, key, base_octave=0).all_positions
+        row = [None] * 128
+        for index, position in enumerate(positions):
+            row[position] = tuple(positions[index + interval] for interval in self.intervals
+                                  if 0 <= index + interval < len(positions))
+        return row
+
 
 def possible_keys(positions):
     key_set = set(range(12))
@@ -109,17 +158,36 @@ class KeyTracker(object):
 
         :param capacity: The amount of notes to keep in memory when deciding what the key is
         """
-        self.queue = Queue()
         self.capacity = capacity
+        # The number of notes that have been added
+        self.count = 0
+        # For each key, the count at which the last note outside of that key was added
+        self.last_misses = [0] * 12
+        self.__keys_mask = 1 << Key.C
+        self.__key = Key.C
 
     def add_note(self, note):
         """
 
         :param note: An integer giving the midi position (0 - 127)
         """
-        self.queue.put(note)
-        if len(self.queue.queue) > self.capacity:
-            self.queue.get()
+        self.count += 1
+        mask = key_masks[note]
+        last_misses = self.last_misses
+        for k in range(12):
+            if not mask >> k & 1:
+                last_misses[k] = self.count
+
+        # Notes before the start of the window are forgotten
+        window_start = self.count - self.capacity
+        # The keys that fit the longest run of recent notes are those whose last miss is oldest
+        oldest = max(min(last_misses), window_start)
+        keys_mask = 0
+        for k in range(12):
+            if last_misses[k] <= oldest:
+                keys_mask |= 1 << k
+        self.__keys_mask = keys_mask
+        self.__key = (keys_mask & -keys_mask).bit_length() - 1
 
     @property
     def key(self):
@@ -127,7 +195,7 @@ class KeyTracker(object):
 
         :return: The most likely key given the notes that have been passed in
         """
-        return list(self.keys)[0]
+        return self.__key
 
     @property
     def scale(self):
@@ -137,20 +205,21 @@ class KeyTracker(object):
         """
         return scale_array[self.key]
 
+    @property
+    def keys_mask(self):
+        """
+
+        :return: Possible keys given notes recently passed in as a 12 bit mask
+        """
+        return self.__keys_mask
+
     @property
     def keys(self):
         """
 
-        :return: A list of possible keys given notes recently passed in
+        :return: A set of possible keys given notes recently passed in
         """
-        if len(self.queue.queue) == 0:
-            return Key.C
-        keys = []
-        note_list = list(self.queue.queue)
-        while len(keys) == 0:
-            keys = possible_keys(note_list)
-            note_list = note_list[1:]
-        return keys
+        return {k for k in Key.all() if self.__keys_mask >> k & 1}
 
 
 class KeySelectionTestCase(unittest.TestCase):
@@ -199,6 +268,40 @@ class KeySelectionTestCase(unittest.TestCase):
         self.assertTrue(Key.C not in key_tracker.keys)
         self.assertTrue(Key.D in key_tracker.keys)
 
+    def test_harmony_table(self):
+        table = HarmonyTable([0, 2, 4])
+        self.assertEqual((60, 64, 67), table.chord(Key.C, 60))
+        self.assertEqual((62, 65, 69), table.chord(Key.C, 62))
+        self.assertEqual((62, 66, 69), table.chord(Key.D, 62))
+        self.assertEqual(None, table.chord(Key.C, 61))
+        self.assertEqual((127,), table.chord(Key.C, 127))
+
+    def test_harmony_table_matches_scale(self):
+        table = HarmonyTable([1, 3])
+        for position in scale_array[Key.E].all_positions[:-3]:
+            self.assertEqual(tuple(scale_array[Key.E].position_at_interval(position, interval) for interval in [1, 3]),
+                             table.chord(Key.E, position))
+
+    def test_key_tracker_window(self):
+        key_tracker = KeyTracker(capacity=2)
+        key_tracker.add_note(1)
+        key_tracker.add_note(0)
+        key_tracker.add_note(2)
+        self.assertEqual(possible_keys([0, 2]), key_tracker.keys)
+        self.assertEqual(min(possible_keys([0, 2])), key_tracker.key)
+
+    def test_key_tracker_matches_intersection(self):
+        notes = [60, 62, 64, 66, 61, 63, 65, 70, 72, 59, 57]
+        key_tracker = KeyTracker(capacity=4)
+        for n, note in enumerate(notes):
+            key_tracker.add_note(note)
+            note_list = notes[max(n - 3, 0):n + 1]
+            keys = set()
+            while len(keys) == 0:
+                keys = possible_keys(note_list)
+                note_list = note_list[1:]
+            self.assertEqual(keys, key_tracker.keys)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,588 @@
+import logging
+import unittest
+from collections import deque
+from threading import Thread, Lock, Condition, Event
+
+import mido
+
+from bandwidth import TokenBucket, Bandwidth
+from instrumentation import recorder
+from clock import wall_clock, VirtualClock
+import event
+
+logger = logging.getLogger(__name__)
+
+# Lanes, from highest to lowest priority. Game sound effects and hit notes go ahead of the track, which goes ahead
+# of control changes.
+EFFECTS = "effects"
+NOTES = "notes"
+CONTROL = "control"
+
+# What a full lane does with a new message
+DROP_NEWEST = "drop_newest"
+DROP_OLDEST = "drop_oldest"
+
+# (name, size, policy) for each lane in priority order
+DEFAULT_LANES = [(EFFECTS, 64, DROP_OLDEST), (NOTES, 1024, DROP_NEWEST), (CONTROL, 256, DROP_OLDEST)]
+
+# Messages that go in the control lane unless another lane is given
+CONTROL_TYPES = ("control_change", "pitchwheel", "aftertouch", "polytouch")
+
+# How a port stops notes. STOP_NOTES sends a note_off for each note that is sounding. The others send a single
+# control change per channel for devices that support it.
+STOP_NOTES = "notes"
+ALL_NOTES_OFF = "all_notes_off"
+ALL_SOUND_OFF = "all_sound_off"
+STOP_CONTROLS = {ALL_NOTES_OFF: 123, ALL_SOUND_OFF: 120}
+
+
+def is_note_off(msg):
+    """
+    :param msg: A midi message
+    :return: True if it stops a note
+    """
+    return msg.type == "note_off" or (msg.type == "note_on" and msg.velocity == 0)
+
+
+class Lane(object):
+    """A bounded queue of messages waiting to be sent"""
+
+    def __init__(self, name, size, policy=DROP_NEWEST):
+        """
+
+        :param name: The name of the lane
+        :param size: The number of messages that can be waiting in the lane
+        :param policy: DROP_NEWEST to discard new messages when the lane is full or DROP_OLDEST to discard the message
+        that has been waiting longest
+        """
+        if policy not in (DROP_NEWEST, DROP_OLDEST):
+            raise AssertionError("No drop policy named {}".format(policy))
+        self.name = name
+        self.size = size
+        self.policy = policy
+        self.messages = deque()
+        self.dropped = 0
+        self.max_length = 0
+
+    def put(self, msg, stamp=None):
+        """
+        Add a message to the lane, dropping a message if the lane is full
+        :param msg: A midi message
+        :param stamp: (scheduled time, queued time) if instrumentation is enabled or None
+        """
+        if len(self.messages) >= self.size and not is_note_off(msg):
+            # A note_off is never dropped, as a note left sounding is worse than a lane running over its size
+            self.dropped += 1
+            if self.policy == DROP_NEWEST:
+                return
+            index = next((index for index, (waiting, _) in enumerate(self.messages) if not is_note_off(waiting)), None)
+            if index is None:
+                return
+            del self.messages[index]
+        self.messages.append((msg, stamp))
+        self.max_length = max(self.max_length, len(self.messages))
+
+    @property
+    def stats(self):
+        return {"queued": len(self.messages), "dropped": self.dropped, "max_length": self.max_length}
+
+
+class StopNotes(object):
+    """
+    A request for the sender thread to stop every note sounding on some channels. done is set once the note_offs have
+    been sent.
+    """
+
+    def __init__(self, channels):
+        self.channels = set(channels)
+        self.done = Event()
+
+
+class OutputPort(object):
+    """
+    A midi output port whose messages are all sent from one dedicated thread. Sending only puts the message in one
+    of several bounded lanes so a slow or blocking device never holds up the thread that is sending. The sender
+    thread always takes from the highest priority lane that has messages waiting.
+
+    A port can also be given a bandwidth, in which case the sender thread keeps to its byte rate with a token bucket.
+    A message that there is no budget for waits at the head of its lane, or is dropped if its type is one that the
+    bandwidth drops, so that a burst never backs up behind the link and makes everything late.
+    """
+
+    def __init__(self, name, port, lanes=DEFAULT_LANES, stop_mode=STOP_NOTES, clock=wall_clock, threaded=True,
+                 bandwidth=None):
+        """
+
+        :param name: The name the port was opened with
+        :param port: The underlying port (anything with a send method, e.g. a mido output port)
+        :param lanes: (name, size, policy) for each lane in priority order
+        :param stop_mode: How notes are stopped (STOP_NOTES, ALL_NOTES_OFF or ALL_SOUND_OFF)
+        :param clock: The clock that send times are measured with (see clock)
+        :param threaded: If False messages are sent straight away on the calling thread rather than queued, so that
+        playback with a virtual clock is deterministic
+        :param bandwidth: A bandwidth.Bandwidth to keep to or None to send as fast as the underlying port allows. Only
+        the sender thread keeps to it, so it has no effect on an unthreaded port.
+        """
+        if stop_mode not in (STOP_NOTES, ALL_NOTES_OFF, ALL_SOUND_OFF):
+            raise AssertionError("No stop mode named {}".format(stop_mode))
+        self.name = name
+        self.port = port
+        self.stop_mode = stop_mode
+        self.lanes = [Lane(*lane) for lane in lanes]
+        self.lanes_by_name = {lane.name: lane for lane in self.lanes}
+        # Requests that are handled before any lane
+        self.commands = deque()
+        self.condition = Condition()
+        # A bitmap of the notes sounding on each channel with bit n set for note n
+        self.active_notes = [0] * 16
+        self.sent = 0
+        self.errors = 0
+        self.total_send_time = 0.
+        self.max_send_time = 0.
+        self.clock = clock
+        self.bandwidth = bandwidth
+        self.budget = None
+        if bandwidth is not None:
+            self.budget = TokenBucket(bandwidth.bytes_per_second, bandwidth.burst, clock)
+        # Messages that waited for budget and messages dropped for lack of it, by type
+        self.deferred = {}
+        self.over_budget = {}
+        # The message waiting for budget
+        self.waiting = None
+        # True while the sender thread is sending something it has taken from the lanes
+        self.is_sending = False
+        self.thread = None
+        if threaded:
+            self.thread = Thread(target=self.run, name="{} sender".format(name))
+            self.thread.daemon = True
+            self.thread.start()
+
+    def send(self, msg, lane=None):
+        """
+        Queue a message to be sent
+        :param msg: A midi message or an event.Event
+        :param lane: The name of the lane to send the message in. By default control changes go in the control lane
+        and everything else in the notes lane.
+        """
+        if lane is None:
+            lane = CONTROL if msg.type in CONTROL_TYPES else NOTES
+        stamp = None
+        if recorder.enabled:
+            queued = self.clock.now()
+            scheduled = recorder.scheduled
+            stamp = (queued if scheduled is None else scheduled, queued)
+        with self.condition:
+            if self.thread is None:
+                self.dispatch(msg, stamp)
+                return
+            self.lanes_by_name[lane].put(msg, stamp)
+            self.condition.notify_all()
+
+    def stop_notes(self, channels=range(16)):
+        """
+        Stop every note sounding on some channels. Note_ons for those channels that are still waiting are discarded
+        straight away and the sender thread sends the note_offs ahead of anything else. Does not wait for the sender
+        thread, so it is safe to call from the thread that plays tracks; messages sent afterwards are not affected.
+        :param channels: Channel numbers
+        :return: The StopNotes request, whose done event can be waited on
+        """
+        command = StopNotes(channels)
+        with self.condition:
+            for lane in self.lanes:
+                lane.messages = deque((msg, stamp) for msg, stamp in lane.messages
+                                      if not (msg.type == "note_on" and msg.channel in command.channels))
+            if self.thread is None:
+                self.handle_stop_notes(command)
+            else:
+                self.commands.append(command)
+                self.condition.notify_all()
+        return command
+
+    def drain(self, timeout=None):
+        """
+        Wait for everything that has been queued to be sent
+        :param timeout: The longest time to wait in seconds or None to wait for as long as it takes
+        :return: True if everything was sent
+        """
+        deadline = None if timeout is None else wall_clock.now() + timeout
+        with self.condition:
+            while self.commands or self.is_sending or any(lane.messages for lane in self.lanes):
+                if deadline is None:
+                    self.condition.wait()
+                    continue
+                remaining = deadline - wall_clock.now()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def next_message(self):
+        """
+        Wait for a message
+        :return: The next command or message from the highest priority lane with messages waiting and its stamp
+        (None for commands)
+        """
+        with self.condition:
+            while True:
+                if self.commands:
+                    self.is_sending = True
+                    return self.commands.popleft(), None
+                lane = next((lane for lane in self.lanes if lane.messages), None)
+                if lane is None:
+                    self.condition.wait()
+                    continue
+                if self.budget is not None:
+                    msg = lane.messages[0][0]
+                    cost = self.cost(msg)
+                    delay = self.budget.delay(cost)
+                    if delay > 0:
+                        if msg.type in self.bandwidth.drop_types:
+                            lane.messages.popleft()
+                            self.over_budget[msg.type] = self.over_budget.get(msg.type, 0) + 1
+                        else:
+                            if msg is not self.waiting:
+                                self.waiting = msg
+                                self.deferred[msg.type] = self.deferred.get(msg.type, 0) + 1
+                            # A higher priority message may arrive in the meantime and go first
+                            self.clock.wait(self.condition, delay)
+                        continue
+                    self.budget.take(cost)
+                self.is_sending = True
+                return lane.messages.popleft()
+
+    def cost(self, msg):
+        """
+        :param msg: A channel message
+        :return: The number of bytes it takes up on the link
+        """
+        return 2 if msg.type in ("program_change", "aftertouch") else 3
+
+    @property
+    def dropped(self):
+        return sum(lane.dropped for lane in self.lanes) + sum(self.over_budget.values())
+
+    def run(self):
+        while True:
+            msg, stamp = self.next_message()
+            if isinstance(msg, StopNotes):
+                self.handle_stop_notes(msg)
+            else:
+                self.dispatch(msg, stamp)
+            with self.condition:
+                self.is_sending = False
+                self.condition.notify_all()
+
+    def dispatch(self, msg, stamp):
+        """
+        Send a message taken from a lane
+        :param msg: A midi message
+        :param stamp: (scheduled time, queued time) if instrumentation is enabled or None
+        """
+        if stamp is None:
+            self.send_now(msg)
+            return
+        scheduled, queued = stamp
+        dequeued = self.clock.now()
+        self.send_now(msg)
+        recorder.record_send(self.name, getattr(msg, "channel", None), scheduled, queued, dequeued, self.clock.now())
+
+    def send_now(self, msg):
+        """
+        Send a message on the calling thread, keeping track of which notes are sounding
+        :param msg: A midi message or an event.Event, which is converted to a mido message here
+        """
+        start = self.clock.now()
+        try:
+            self.port.send(msg.to_message() if isinstance(msg, event.Event) else msg)
+            self.sent += 1
+            if msg.type == "note_on" and msg.velocity > 0:
+                self.active_notes[msg.channel] |= 1 << msg.note
+            elif msg.type in ("note_on", "note_off"):
+                self.active_notes[msg.channel] &= ~(1 << msg.note)
+        except (IOError, ValueError) as e:
+            self.errors += 1
+            logger.exception(e)
+        send_time = self.clock.now() - start
+        self.total_send_time += send_time
+        self.max_send_time = max(self.max_send_time, send_time)
+
+    def send_command_message(self, msg):
+        """Send a message for a command straight away, spending budget that it could not wait for"""
+        if self.budget is not None:
+            self.budget.take(self.cost(msg))
+        self.send_now(msg)
+
+    def handle_stop_notes(self, command):
+        for channel in command.channels:
+            if self.stop_mode == STOP_NOTES:
+                notes = self.active_notes[channel]
+                note = 0
+                while notes:
+                    if notes & 1:
+                        self.send_command_message(mido.Message("note_off", channel=channel, note=note, velocity=0))
+                    notes >>= 1
+                    note += 1
+            else:
+                self.send_command_message(mido.Message("control_change", channel=channel,
+                                                       control=STOP_CONTROLS[self.stop_mode], value=0))
+                self.active_notes[channel] = 0
+        command.done.set()
+
+    @property
+    def stats(self):
+        """A dictionary of counters describing how this port has performed"""
+        return {"sent": self.sent,
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "lanes": {lane.name: lane.stats for lane in self.lanes},
+                "deferred": dict(self.deferred),
+                "over_budget": dict(self.over_budget),
+                "mean_send_time": self.total_send_time / self.sent if self.sent > 0 else 0.,
+                "max_send_time": self.max_send_time}
+
+    def close(self):
+        self.port.close()
+
+    def __repr__(self):
+        return "<OutputPort name={}>".format(self.name)
+
+
+class RecordingPort(object):
+    """
+    An underlying port that keeps every message it is sent in memory along with the time it was sent, so that playback
+    can be checked without a midi device. With a virtual clock and an unthreaded OutputPort playback runs as fast as
+    it can:
+
+        clock = VirtualClock(free_running=True)
+        audio.use_port(OutputPort("recording", RecordingPort(clock), clock=clock, threaded=False))
+    """
+
+    def __init__(self, clock=wall_clock):
+        """
+
+        :param clock: The clock that messages are timed with
+        """
+        self.clock = clock
+        # (time, message) pairs in the order they were sent
+        self.messages = []
+
+    def send(self, msg):
+        self.messages.append((self.clock.now(), msg))
+
+    def close(self):
+        pass
+
+
+class PortRegistry(object):
+    """Opens each named output port once and shares it between everything that sends to it"""
+
+    def __init__(self, open_output=None, lanes=DEFAULT_LANES, stop_modes=None, bandwidth=None):
+        """
+
+        :param open_output: A function that opens an underlying port given its name (None for the default port).
+        Defaults to mido.open_output, looked up when a port is opened so that it uses the backend set by then.
+        :param lanes: (name, size, policy) for each lane of a port in priority order
+        :param stop_modes: A dictionary of stop modes by (part of) port name. The mode under "default" is used for
+        ports that do not match any other name.
+        :param bandwidth: The bandwidth.Bandwidth each port keeps to or None for no limit
+        """
+        self.open_output = open_output
+        self.lanes = lanes
+        self.stop_modes = stop_modes or {"default": STOP_NOTES}
+        self.bandwidth = bandwidth
+        self.ports = {}
+        self.lock = Lock()
+
+    def open(self, name=None):
+        """
+        Get the port with a given name, opening it if it has not been opened yet
+        :param name: The name of the port or None for the default port
+        :return: An OutputPort
+        :raises IOError: If the port could not be opened
+        """
+        with self.lock:
+            if name not in self.ports:
+                # noinspection PyUnresolvedReferences
+                open_output = self.open_output or mido.open_output
+                self.ports[name] = OutputPort(name, open_output(name), self.lanes, self.stop_mode_for(name),
+                                              bandwidth=self.bandwidth)
+            return self.ports[name]
+
+    def stop_mode_for(self, name):
+        """
+        :param name: The name of a port
+        :return: The stop mode to use for that port
+        """
+        for key, stop_mode in self.stop_modes.items():
+            if key != "default" and name is not None and key.lower() in name.lower():
+                return stop_mode
+        return self.stop_modes.get("default", STOP_NOTES)
+
+    def register(self, name, port):
+        """
+        Share a port that has already been opened
+        :param name: The name to register the port under
+        :param port: The underlying port
+        :return: An OutputPort
+        """
+        with self.lock:
+            self.ports[name] = OutputPort(name, port, self.lanes, self.stop_mode_for(name), bandwidth=self.bandwidth)
+            return self.ports[name]
+
+    def stats(self):
+        """
+        :return: A dictionary of stats dictionaries by port name
+        """
+        with self.lock:
+            return {name: port.stats for name, port in self.ports.items()}
+
+
+registry = PortRegistry()
+
+
+class MockMessage(object):
+    def __init__(self, msg_type, number=0, channel=0, note=0, velocity=64):
+        self.type = msg_type
+        self.number = number
+        self.channel = channel
+        self.note = note
+        self.velocity = velocity
+
+
+class MockPort(object):
+    def __init__(self):
+        self.messages = []
+
+    def send(self, msg):
+        self.messages.append(msg)
+
+
+class PortRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mock_ports = {}
+        self.registry = PortRegistry(lambda name: self.mock_ports.setdefault(name, MockPort()))
+
+    def test_open_once(self):
+        self.assertIs(self.registry.open("keys"), self.registry.open("keys"))
+        self.assertIsNot(self.registry.open("keys"), self.registry.open("drums"))
+        self.assertEqual(2, len(self.mock_ports))
+
+    def test_send(self):
+        port = self.registry.open("keys")
+        messages = [MockMessage("note_on", n) for n in range(10)]
+        for msg in messages:
+            port.send(msg)
+        self.assertTrue(port.drain(1.))
+        self.assertEqual(messages, self.mock_ports["keys"].messages)
+        self.assertEqual(10, self.registry.stats()["keys"]["sent"])
+
+    def test_active_notes(self):
+        port = self.registry.open("keys")
+        port.send(MockMessage("note_on", channel=1, note=3))
+        port.send(MockMessage("note_on", channel=1, note=5))
+        port.send(MockMessage("note_off", channel=1, note=3))
+        port.send(MockMessage("note_on", channel=2, note=7, velocity=0))
+        self.assertTrue(port.drain(1.))
+        self.assertEqual(1 << 5, port.active_notes[1])
+        self.assertEqual(0, port.active_notes[2])
+
+        port.stop_notes([1])
+        self.assertTrue(port.drain(1.))
+        self.assertEqual(0, port.active_notes[1])
+        self.assertEqual(("note_off", 1, 5), (port.port.messages[-1].type, port.port.messages[-1].channel,
+                                              port.port.messages[-1].note))
+
+    def test_stop_mode(self):
+        self.registry.stop_modes = {"default": STOP_NOTES, "reface": ALL_NOTES_OFF}
+        self.assertEqual(ALL_NOTES_OFF, self.registry.open("reface DX").stop_mode)
+        self.assertEqual(STOP_NOTES, self.registry.open("keys").stop_mode)
+
+
+class RecordingPortTestCase(unittest.TestCase):
+    def test_unthreaded(self):
+        clock = VirtualClock(free_running=True)
+        port = OutputPort("recording", RecordingPort(clock), clock=clock, threaded=False)
+        port.send(MockMessage("note_on", channel=1, note=3))
+        clock.sleep(2.)
+        port.send(MockMessage("note_on", channel=1, note=5))
+        port.stop_notes([1])
+        self.assertEqual([0., 2., 2., 2.], [time for time, _ in port.port.messages])
+        self.assertEqual(0, port.active_notes[1])
+
+
+class LaneTestCase(unittest.TestCase):
+    def setUp(self):
+        # Bypass the constructor so that no sender thread takes messages from the lanes
+        self.port = OutputPort.__new__(OutputPort)
+        self.port.lanes = [Lane(*lane) for lane in [(EFFECTS, 2, DROP_OLDEST), (NOTES, 2, DROP_NEWEST),
+                                                    (CONTROL, 2, DROP_OLDEST)]]
+        self.port.lanes_by_name = {lane.name: lane for lane in self.port.lanes}
+        self.port.commands = deque()
+        self.port.condition = Condition()
+        self.port.thread = Thread(target=self.port.run)
+        self.port.budget = None
+        self.port.deferred = {}
+        self.port.over_budget = {}
+        self.port.waiting = None
+        self.port.is_sending = False
+
+    def test_priority(self):
+        control = MockMessage("control_change")
+        note = MockMessage("note_on")
+        effect = MockMessage("note_on")
+        self.port.send(control)
+        self.port.send(note)
+        self.port.send(effect, EFFECTS)
+        self.assertEqual([effect, note, control], [self.port.next_message()[0] for _ in range(3)])
+
+    def test_drop_policies(self):
+        notes = [MockMessage("note_on", n) for n in range(3)]
+        controls = [MockMessage("control_change", n) for n in range(3)]
+        for note, control in zip(notes, controls):
+            self.port.send(note)
+            self.port.send(control)
+        self.assertEqual(notes[:2] + controls[1:], [self.port.next_message()[0] for _ in range(4)])
+        self.assertEqual(2, self.port.dropped)
+
+    def test_stop_notes(self):
+        queued = MockMessage("note_on", channel=1)
+        later = MockMessage("note_on", channel=1, note=2)
+        self.port.send(queued)
+        # Returns straight away even though no sender thread is running
+        command = self.port.stop_notes([1])
+        self.port.send(later)
+        self.assertEqual([command, later], [self.port.next_message()[0] for _ in range(2)])
+
+    def test_keeps_note_offs(self):
+        notes = [MockMessage("note_on", n) for n in range(2)]
+        note_offs = [MockMessage("note_off"), MockMessage("note_on", velocity=0)]
+        for msg in notes + note_offs:
+            self.port.send(msg)
+        self.port.send(MockMessage("note_on", 3))
+        self.assertEqual(notes + note_offs, [self.port.next_message()[0] for _ in range(4)])
+        self.assertEqual(1, self.port.dropped)
+
+        # A full lane that drops its oldest message drops the new one if everything waiting is a note_off
+        for msg in note_offs + [MockMessage("note_on", 4)]:
+            self.port.send(msg, EFFECTS)
+        self.assertEqual(note_offs, [self.port.next_message()[0] for _ in range(2)])
+        self.assertEqual(2, self.port.dropped)
+
+    def test_budget(self):
+        clock = VirtualClock(free_running=True)
+        self.port.clock = clock
+        self.port.bandwidth = Bandwidth(1000, burst=6)
+        self.port.budget = TokenBucket(1000, 6, clock)
+        notes = [MockMessage("note_on", n) for n in range(2)]
+        aftertouch = MockMessage("aftertouch")
+        control = MockMessage("control_change")
+        for msg in notes + [aftertouch, control]:
+            self.port.send(msg)
+        self.assertEqual(notes + [control], [self.port.next_message()[0] for _ in range(3)])
+        self.assertAlmostEqual(0.003, clock.now())
+        self.assertEqual({"aftertouch": 1}, self.port.over_budget)
+        self.assertEqual({"control_change": 1}, self.port.deferred)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import logging
+from Queue import Queue
+from threading import Thread, Condition
+
+logger = logging.getLogger(__name__)
+
+
+class TrackPreloader(Thread):
+    """Prepares tracks on a worker thread so that they are ready to play as soon as they are needed"""
+
+    def __init__(self, make_track):
+        """
+
+        :param make_track: A function that takes a track name and returns a Track that has not been started
+        """
+        super(TrackPreloader, self).__init__()
+        self.daemon = True
+        self.make_track = make_track
+        self.requests = Queue()
+        self.condition = Condition()
+        # Names of tracks waiting to be prepared or being prepared
+        self.pending = set()
+        # Prepared tracks by name
+        self.tracks = {}
+
+    def preload(self, names):
+        """
+        Prepare tracks in the background, discarding any other prepared tracks
+        :param names: The names of the tracks that are likely to be needed next
+        """
+        with self.condition:
+            for name in self.tracks.keys():
+                if name not in names:
+                    del self.tracks[name]
+            names = [name for name in names if name not in self.tracks and name not in self.pending]
+            self.pending.update(names)
+        for name in names:
+            self.requests.put(name)
+
+    def get(self, name):
+        """
+        Take a prepared track, waiting for it if it is being prepared or preparing it now if it was not requested
+        :param name: The name of the track
+        :return: A Track that has not been started
+        """
+        with self.condition:
+            while name in self.pending:
+                self.condition.wait()
+            track = self.tracks.pop(name, None)
+        if track is None:
+            track = self.make_track(name)
+        return track
+
+    def run(self):
+        while True:
+            name = self.requests.get()
+            try:
+                track = self.make_track(name)
+            except Exception as e:
+                logger.exception(e)
+                track = None
+            with self.condition:
+                self.pending.discard(name)
+                if track is not None:
+                    self.tracks[name] = track
+                self.condition.notify_all()
@@ -0,0 +1,122 @@
+import unittest
+
+from clock import wall_clock, VirtualClock
+
+# Longest single sleep so that tempo changes and stops are picked up while waiting for a distant event
+MAX_SLEEP = 0.05
+# If playback falls further behind than this (e.g. the process was suspended) the origin is moved forward rather
+# than bursting every missed event at once
+LATE_LIMIT = 0.5
+
+
+class Scheduler(object):
+    """
+    Converts positions in a song (in seconds at normal tempo) into absolute deadlines measured from a single
+    monotonic start point, so that timing errors do not accumulate over a long loop
+    """
+
+    def __init__(self, tempo_shift=1., late_limit=LATE_LIMIT, clock=wall_clock):
+        """
+
+        :param tempo_shift: The initial tempo shift. 0.5 is half tempo and 2 double tempo
+        :param late_limit: How far behind (in seconds) playback may fall before the origin is moved forward
+        :param clock: The clock to measure and sleep with (see clock)
+        """
+        self.late_limit = late_limit
+        self.clock = clock
+        # The origin and tempo shift are swapped together so that readers never see one without the other
+        self.__state = (0., tempo_shift)
+
+    def start(self, position=0.):
+        """
+        Start counting from now
+        :param position: The position in the song that corresponds to now
+        """
+        self.__state = (self.clock.now() - position / self.tempo_shift, self.tempo_shift)
+
+    @property
+    def position(self):
+        """The current position in the song"""
+        origin, tempo_shift = self.__state
+        return (self.clock.now() - origin) * tempo_shift
+
+    @property
+    def tempo_shift(self):
+        return self.__state[1]
+
+    @tempo_shift.setter
+    def tempo_shift(self, tempo_shift):
+        position = self.position
+        self.__state = (self.clock.now() - position / tempo_shift, tempo_shift)
+
+    def rewind(self, seconds):
+        """
+        Move the song position back without disturbing the deadlines that have already been met. Used to start the
+        next pass of a loop exactly where the last one ended.
+        :param seconds: The amount of song time to move back by
+        """
+        origin, tempo_shift = self.__state
+        self.__state = (origin + seconds / tempo_shift, tempo_shift)
+
+    def deadline(self, position):
+        """
+        :param position: A position in the song
+        :return: The absolute time at which that position should be played
+        """
+        origin, tempo_shift = self.__state
+        return origin + position / tempo_shift
+
+    def wait_until(self, position):
+        """
+        Sleep until a position in the song is reached. If it has already passed return straight away so that late
+        events are caught up on without stalling.
+        :param position: A position in the song
+        :return: How late (in seconds) the position was reached
+        """
+        while True:
+            delay = self.deadline(position) - self.clock.now()
+            if delay <= 0:
+                break
+            self.clock.sleep(min(delay, MAX_SLEEP))
+        lateness = -delay
+        if lateness > self.late_limit:
+            origin, tempo_shift = self.__state
+            self.__state = (origin + lateness, tempo_shift)
+        return lateness
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock(start=10.)
+        self.scheduler = Scheduler(clock=self.clock)
+        self.scheduler.start()
+
+    def test_deadline(self):
+        self.assertEqual(11., self.scheduler.deadline(1.))
+        self.clock.advance(0.5)
+        self.assertEqual(0.5, self.scheduler.position)
+
+    def test_tempo_shift_rebases(self):
+        self.clock.advance(1.)
+        self.scheduler.tempo_shift = 2.
+        self.assertEqual(1., self.scheduler.position)
+        self.assertEqual(11.5, self.scheduler.deadline(2.))
+
+    def test_rewind(self):
+        self.clock.advance(2.)
+        self.scheduler.rewind(2.)
+        self.assertEqual(0., self.scheduler.position)
+        self.assertEqual(13., self.scheduler.deadline(1.))
+
+    def test_late(self):
+        self.clock.advance(0.2)
+        self.assertAlmostEqual(0.2, self.scheduler.wait_until(0.))
+        self.assertEqual(11., self.scheduler.deadline(1.))
+
+        self.clock.advance(1.8)
+        self.assertAlmostEqual(2., self.scheduler.wait_until(0.))
+        self.assertAlmostEqual(13., self.scheduler.deadline(1.))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,256 @@
+import unittest
+from array import array
+from bisect import bisect_left, bisect_right
+
+import mido
+
+from event import Event, TYPES
+
+DEFAULT_TEMPO = 500000
+DEFAULT_BEATS_PER_BAR = 4
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+POLYTOUCH = 0xA0
+CONTROL_CHANGE = 0xB0
+PROGRAM_CHANGE = 0xC0
+AFTERTOUCH = 0xD0
+PITCHWHEEL = 0xE0
+
+# Channel messages with a single data byte
+SHORT_STATUSES = (PROGRAM_CHANGE, AFTERTOUCH)
+
+# Messages that leave a channel in a state that lasts until the next message of the same kind
+STATE_STATUSES = (CONTROL_CHANGE, PROGRAM_CHANGE, PITCHWHEEL)
+
+# Control changes from this number up are channel mode messages (e.g. all notes off) rather than state
+CHANNEL_MODE_CONTROL = 120
+
+
+class Timeline(object):
+    """
+    A midi file flattened into parallel arrays so that it can be played back without merging tracks or converting
+    ticks to seconds on every pass
+    """
+
+    # The names of the arrays that make up a timeline, in the order they are cached
+    ARRAYS = ("times", "ticks", "statuses", "data1", "data2", "channels", "program_channels", "programs",
+              "tempo_ticks", "tempo_times", "tempos")
+
+    def __init__(self, ticks_per_beat=480):
+        """
+
+        :param ticks_per_beat: The resolution of the file this timeline was compiled from
+        """
+        self.ticks_per_beat = ticks_per_beat
+        # The first tempo (in microseconds per beat) and time signature in the file
+        self.tempo = DEFAULT_TEMPO
+        self.beats_per_bar = DEFAULT_BEATS_PER_BAR
+        # Absolute time of each event in seconds from the start of the file
+        self.times = array('d')
+        # Absolute time of each event in ticks
+        self.ticks = array('I')
+        # Status nibble (e.g. 0x90 for note_on) with the channel removed
+        self.statuses = array('B')
+        self.data1 = array('B')
+        self.data2 = array('B')
+        self.channels = array('B')
+        # Programs set by the first message of each track in the file
+        self.program_channels = array('B')
+        self.programs = array('B')
+        # Every tempo change in the file: its time in ticks and seconds and the new tempo (microseconds per beat)
+        self.tempo_ticks = array('I')
+        self.tempo_times = array('d')
+        self.tempos = array('I')
+        # Time at which the file ends, including any trailing delta after the last event
+        self.length = 0.
+        # Indices of the events that set channel state (see chase), found when first needed
+        self.__state_indices = None
+
+    @classmethod
+    def from_midi_file(cls, mid):
+        """
+        Compile a midi file into a timeline
+        :param mid: A mido.MidiFile
+        :return: A Timeline
+        """
+        timeline = cls(mid.ticks_per_beat)
+        for track in mid.tracks:
+            if len(track) > 0 and track[0].type == "program_change":
+                timeline.program_channels.append(track[0].channel)
+                timeline.programs.append(track[0].program)
+        tempo = None
+        beats_per_bar = None
+        now = 0.
+        tick = 0
+        for msg in mido.merge_tracks(mid.tracks):
+            if msg.time > 0:
+                now += mido.tick2second(msg.time, mid.ticks_per_beat, tempo or DEFAULT_TEMPO)
+                tick += msg.time
+            if msg.type == 'set_tempo':
+                if tempo is None:
+                    timeline.tempo = msg.tempo
+                tempo = msg.tempo
+                timeline.tempo_ticks.append(tick)
+                timeline.tempo_times.append(now)
+                timeline.tempos.append(msg.tempo)
+            elif msg.type == 'time_signature':
+                if beats_per_bar is None:
+                    beats_per_bar = timeline.beats_per_bar = msg.numerator
+            elif not msg.is_meta and hasattr(msg, "channel"):
+                timeline.append(now, msg.bytes(), tick)
+        timeline.length = now
+        return timeline
+
+    @property
+    def bar_length(self):
+        """The length of a bar in seconds at the first tempo in the file"""
+        return self.beats_per_bar * self.tempo / 1e6
+
+    def append(self, time, data, tick=0):
+        """
+        Add an event to the end of the timeline
+        :param time: The absolute time of the event in seconds
+        :param data: The raw bytes of a channel message
+        :param tick: The absolute time of the event in ticks
+        """
+        self.times.append(time)
+        self.ticks.append(tick)
+        self.statuses.append(data[0] & 0xF0)
+        self.channels.append(data[0] & 0x0F)
+        self.data1.append(data[1] if len(data) > 1 else 0)
+        self.data2.append(data[2] if len(data) > 2 else 0)
+
+    def seconds_at_tick(self, tick):
+        """
+        :param tick: A time in ticks from the start of the file
+        :return: The same time in seconds, following any tempo changes before it
+        """
+        index = bisect_right(self.tempo_ticks, tick) - 1
+        if index < 0:
+            return mido.tick2second(tick, self.ticks_per_beat, DEFAULT_TEMPO)
+        return self.tempo_times[index] + mido.tick2second(tick - self.tempo_ticks[index], self.ticks_per_beat,
+                                                          self.tempos[index])
+
+    def index_at_tick(self, tick):
+        """
+        :param tick: A time in ticks from the start of the file
+        :return: The index of the first event at or after that time
+        """
+        return bisect_left(self.ticks, tick)
+
+    def index_at_time(self, seconds):
+        """
+        :param seconds: A time in seconds from the start of the file
+        :return: The index of the first event at or after that time
+        """
+        return bisect_left(self.times, seconds)
+
+    @property
+    def state_indices(self):
+        """The indices of the program changes, control changes and pitch bends in the timeline"""
+        if self.__state_indices is None:
+            self.__state_indices = array('I', (index for index, status in enumerate(self.statuses)
+                                               if status in STATE_STATUSES))
+        return self.__state_indices
+
+    def chase(self, index):
+        """
+        Find the state that each channel is left in by the events before an index, so that playback can start there
+        and sound as if it had played from the beginning. Only the program changes, control changes and pitch bends
+        are searched rather than every event.
+        :param index: The index of an event
+        :return: Events that recreate the latest program, value of each controller and pitch bend of every channel, in
+        the order they appear in the file
+        """
+        state_indices = self.state_indices
+        latest = {}
+        for position in range(bisect_left(state_indices, index) - 1, -1, -1):
+            event_index = state_indices[position]
+            status = self.statuses[event_index]
+            if status == CONTROL_CHANGE:
+                if self.data1[event_index] >= CHANNEL_MODE_CONTROL:
+                    continue
+                key = (status, self.channels[event_index], self.data1[event_index])
+            else:
+                key = (status, self.channels[event_index])
+            latest.setdefault(key, event_index)
+        return [self.event(latest_index) for latest_index in sorted(latest.values())]
+
+    def bytes(self, index):
+        """
+        :param index: The index of an event
+        :return: The raw bytes of the event
+        """
+        status = self.statuses[index]
+        if status in SHORT_STATUSES:
+            return [status | self.channels[index], self.data1[index]]
+        return [status | self.channels[index], self.data1[index], self.data2[index]]
+
+    def event(self, index):
+        """
+        :param index: The index of an event
+        :return: The event as an Event
+        """
+        return Event(TYPES[self.statuses[index]], self.channels[index], self.data1[index], self.data2[index])
+
+    def message(self, index):
+        """
+        :param index: The index of an event
+        :return: A new mido message for the event
+        """
+        return mido.Message.from_bytes(self.bytes(index))
+
+    def __len__(self):
+        return len(self.times)
+
+
+class TimelineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mid = mido.MidiFile(ticks_per_beat=480)
+        track = mido.MidiTrack()
+        track.append(mido.Message('program_change', channel=1, program=33, time=0))
+        track.append(mido.Message('note_on', channel=1, note=60, velocity=100, time=480))
+        track.append(mido.Message('note_off', channel=1, note=60, velocity=0, time=480))
+        track.append(mido.MetaMessage('end_of_track', time=480))
+        self.mid.tracks.append(track)
+
+    def test_compile(self):
+        timeline = Timeline.from_midi_file(self.mid)
+        self.assertEqual(3, len(timeline))
+        self.assertEqual([0., 0.5, 1.], list(timeline.times))
+        self.assertEqual(1.5, timeline.length)
+        self.assertEqual([1], list(timeline.program_channels))
+        self.assertEqual([33], list(timeline.programs))
+
+    def test_ticks(self):
+        self.mid.tracks[0].insert(2, mido.MetaMessage('set_tempo', tempo=250000, time=0))
+        timeline = Timeline.from_midi_file(self.mid)
+        self.assertEqual([0, 480, 960], list(timeline.ticks))
+        self.assertEqual([0., 0.5, 0.75], list(timeline.times))
+        self.assertEqual(0.25, timeline.seconds_at_tick(240))
+        self.assertEqual(0.75, timeline.seconds_at_tick(960))
+        self.assertEqual(1, timeline.index_at_tick(480))
+        self.assertEqual(2, timeline.index_at_tick(481))
+
+    def test_chase(self):
+        timeline = Timeline()
+        for time, data in enumerate([[0xC0, 5], [0xB0, 7, 100], [0x90, 60, 100], [0xB0, 7, 50], [0xE1, 0, 70],
+                                     [0xB0, 123, 0], [0xC0, 6], [0x80, 60, 0]]):
+            timeline.append(float(time), data)
+        self.assertEqual(5, timeline.index_at_time(4.5))
+        self.assertEqual([Event("program_change", 0, 5, 0), Event("control_change", 0, 7, 50),
+                          Event("pitchwheel", 1, 0, 70)], timeline.chase(6))
+        self.assertEqual([Event("control_change", 0, 7, 50), Event("pitchwheel", 1, 0, 70),
+                          Event("program_change", 0, 6, 0)], timeline.chase(8))
+        self.assertEqual([], timeline.chase(0))
+
+    def test_messages(self):
+        timeline = Timeline.from_midi_file(self.mid)
+        self.assertEqual(mido.Message('program_change', channel=1, program=33), timeline.message(0))
+        self.assertEqual(Event("note_on", 1, 60, 100), timeline.event(1))
+        self.assertEqual(mido.Message('note_on', channel=1, note=60, velocity=100), timeline.message(1))
+
+
+if __name__ == "__main__":
+    unittest.main()
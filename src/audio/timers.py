@@ -0,0 +1,167 @@
+import logging
+import unittest
+from heapq import heappush, heappop, heapify
+from itertools import count
+from threading import Thread, Event, current_thread
+
+from clock import wall_clock, VirtualClock
+
+logger = logging.getLogger(__name__)
+
+
+class Timer(object):
+    """A callback waiting to be called at a given time"""
+
+    def __init__(self, timers, deadline, callback):
+        self.timers = timers
+        self.deadline = deadline
+        self.callback = callback
+        self.is_cancelled = False
+        # The entry of this timer in the heap of its Timers
+        self.entry = None
+
+    def cancel(self):
+        """Stop the callback being called if it has not been called already"""
+        self.timers.cancel(self)
+
+
+class Timers(Thread):
+    """
+    Calls callbacks at given times from a single thread. Timers are kept in a heap and the thread sleeps until the
+    earliest one is due, so it never wakes while there is nothing to do.
+    """
+
+    def __init__(self, clock=wall_clock):
+        """
+
+        :param clock: The clock that deadlines are measured with
+        """
+        super(Timers, self).__init__(name="timers")
+        self.daemon = True
+        self.clock = clock
+        self.condition = clock.new_condition()
+        # (deadline, sequence number, Timer) so that timers due at the same time are called in the order they were set
+        self.heap = []
+        self.sequence = count()
+        self.__is_started = False
+
+    def call_at(self, deadline, callback):
+        """
+        :param deadline: The time (by the clock of these timers) at which to call the callback
+        :param callback: A function taking no arguments
+        :return: A Timer that can be cancelled
+        """
+        timer = Timer(self, deadline, callback)
+        with self.condition:
+            timer.entry = (deadline, next(self.sequence), timer)
+            heappush(self.heap, timer.entry)
+            if self.heap[0] is timer.entry:
+                self.clock.notify(self.condition)
+            if not self.__is_started:
+                self.__is_started = True
+                self.clock.register(self)
+                self.start()
+        return timer
+
+    def call_later(self, seconds, callback):
+        """
+        :param seconds: How long from now to call the callback
+        :param callback: A function taking no arguments
+        :return: A Timer that can be cancelled
+        """
+        return self.call_at(self.clock.now() + seconds, callback)
+
+    def cancel(self, timer):
+        """
+        Take a timer out of the heap so that the thread does not wake for it (see Timer.cancel)
+        :param timer: A Timer set by these timers
+        """
+        with self.condition:
+            timer.is_cancelled = True
+            if timer.entry not in self.heap:
+                # Already called
+                return
+            is_earliest = self.heap[0] is timer.entry
+            self.heap.remove(timer.entry)
+            heapify(self.heap)
+            if is_earliest:
+                # The thread is sleeping until the deadline of this timer
+                self.clock.notify(self.condition)
+
+    def next_timer(self):
+        """
+        Wait for a timer to be due
+        :return: The Timer
+        """
+        with self.condition:
+            while True:
+                if not self.heap:
+                    self.clock.wait(self.condition, None)
+                    continue
+                delay = self.heap[0][0] - self.clock.now()
+                if delay <= 0:
+                    return heappop(self.heap)[2]
+                self.clock.wait(self.condition, delay)
+
+    def run(self):
+        while True:
+            timer = self.next_timer()
+            try:
+                timer.callback()
+            except Exception as e:
+                logger.exception(e)
+
+
+# Timers for everything that runs in real time
+shared_timers = Timers()
+
+
+class TimersTestCase(unittest.TestCase):
+    def setUp(self):
+        self.timers = Timers()
+
+    def test_order(self):
+        called = []
+        done = Event()
+        self.timers.call_later(0.02, lambda: called.append(2))
+        self.timers.call_later(0.01, lambda: called.append(1))
+        self.timers.call_later(0.03, done.set)
+        self.assertTrue(done.wait(1.))
+        self.assertEqual([1, 2], called)
+
+    def test_cancel(self):
+        called = []
+        done = Event()
+        self.timers.call_later(0.01, lambda: called.append(1)).cancel()
+        self.timers.call_later(0.02, done.set)
+        self.assertTrue(done.wait(1.))
+        self.assertEqual([], called)
+
+    def test_cancel_leaves_heap(self):
+        timers = Timers(VirtualClock())
+        first = timers.call_later(1., lambda: None)
+        second = timers.call_later(2., lambda: None)
+        first.cancel()
+        self.assertEqual([second], [timer for _, _, timer in timers.heap])
+        second.cancel()
+        self.assertEqual([], timers.heap)
+
+    def test_virtual_clock(self):
+        clock = VirtualClock(free_running=True)
+        timers = Timers(clock)
+        called = []
+        timers.call_later(1.5, lambda: called.append(clock.now()))
+        timers.call_later(0.5, lambda: timers.call_later(0.25, lambda: called.append(clock.now())))
+        # Registered so that time waits for this thread as well as the timers
+        clock.register(current_thread())
+        clock.sleep(1.)
+        # Time waited for the timers that were due before it moved on
+        self.assertEqual([0.75], called)
+        self.assertEqual(1., clock.now())
+        clock.sleep(1.)
+        self.assertEqual([0.75, 1.5], called)
+        clock.unregister(current_thread())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,201 @@
+import unittest
+from collections import OrderedDict
+from threading import Lock
+
+import event
+from automation import MockTimers
+from clock import VirtualClock
+
+# Ways of choosing the voice to stop when a channel has no voices left
+OLDEST = "oldest"
+QUIETEST = "quietest"
+STEALING = (OLDEST, QUIETEST)
+
+
+class Voice(object):
+    """A sounding note, which may have been struck more than once without being released"""
+
+    __slots__ = ("channel", "note", "velocity", "start_time", "count")
+
+    def __init__(self, channel, note, velocity, start_time):
+        self.channel = channel
+        self.note = note
+        self.velocity = velocity
+        self.start_time = start_time
+        # How many note_ons are waiting for a note_off. Some synths sound a voice for each of them.
+        self.count = 1
+
+    def note_offs(self):
+        """
+        :return: A note_off event for each time the note was struck
+        """
+        return [event.Event.make("note_off", channel=self.channel, note=self.note) for _ in range(self.count)]
+
+
+class VoiceAllocator(object):
+    """
+    Bounds the notes sounding on a channel. A note_on that would take the channel past its polyphony stops another
+    voice first, and notes that have sounded for longer than max_duration are stopped by a timer so that notes whose
+    note_off never comes (e.g. harmony added by an effect that has since been removed) do not hang.
+
+    Used as the last stage of a channel so that it sees the notes that are actually sent.
+    """
+
+    def __init__(self, timers, stop, polyphony=0, stealing=OLDEST, max_duration=0.):
+        """
+
+        :param timers: The Timers that stop notes that have sounded for too long
+        :param stop: A function that sends a note_off event for a voice that is stopped by a timer
+        :param polyphony: The most notes that can sound at once. 0 for no limit.
+        :param stealing: Which voice to stop when there are none left (OLDEST or QUIETEST)
+        :param max_duration: The longest a note can sound for in seconds. 0 for no limit.
+        """
+        if stealing not in STEALING:
+            raise AssertionError("Voice stealing must be one of {}, not {}".format(STEALING, stealing))
+        self.timers = timers
+        self.clock = timers.clock
+        self.stop = stop
+        self.polyphony = polyphony
+        self.stealing = stealing
+        self.max_duration = max_duration
+        self.lock = Lock()
+        # Voices by (channel, note) in the order they started
+        self.voices = OrderedDict()
+        # The timer that stops the oldest voice or None
+        self.timer = None
+        # How many voices have been stolen and expired
+        self.stolen = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.voices)
+
+    def victim(self):
+        """
+        :return: The key of the voice to stop to make room for another
+        """
+        if self.stealing == QUIETEST:
+            return min(self.voices, key=lambda key: self.voices[key].velocity)
+        return next(iter(self.voices))
+
+    def __call__(self, msgs):
+        """
+        :param msgs: Events to be sent
+        :return: The events to send, with note_offs for any stolen voices and without note_offs for notes that are
+        no longer sounding
+        """
+        output = []
+        with self.lock:
+            for msg in msgs:
+                if msg.type == "note_on" and msg.velocity > 0:
+                    key = (msg.channel, msg.note)
+                    voice = self.voices.pop(key, None)
+                    if voice is not None:
+                        # A note that is struck again keeps its voice, which now needs another note_off
+                        voice.count += 1
+                        voice.velocity = msg.velocity
+                        voice.start_time = self.clock.now()
+                    else:
+                        if 0 < self.polyphony <= len(self.voices):
+                            victim = self.voices.pop(self.victim())
+                            self.stolen += 1
+                            output.extend(victim.note_offs())
+                        voice = Voice(msg.channel, msg.note, msg.velocity, self.clock.now())
+                    self.voices[key] = voice
+                    if self.max_duration > 0 and self.timer is None:
+                        self.timer = self.timers.call_later(self.max_duration, self.expire)
+                elif msg.type in ("note_on", "note_off"):
+                    key = (msg.channel, msg.note)
+                    voice = self.voices.get(key)
+                    if voice is None:
+                        # Already stopped
+                        continue
+                    voice.count -= 1
+                    if voice.count == 0:
+                        del self.voices[key]
+                output.append(msg)
+        return output
+
+    def expire(self):
+        """Stop every voice that has sounded for longer than max_duration"""
+        expired = []
+        with self.lock:
+            self.timer = None
+            now = self.clock.now()
+            while self.voices:
+                key, voice = next(iter(self.voices.items()))
+                delay = voice.start_time + self.max_duration - now
+                if delay > 0:
+                    self.timer = self.timers.call_later(delay, self.expire)
+                    break
+                del self.voices[key]
+                expired.append(voice)
+            self.expired += len(expired)
+        for voice in expired:
+            for note_off in voice.note_offs():
+                self.stop(note_off)
+
+    def clear(self):
+        """Forget every voice, e.g. when the notes have been stopped another way"""
+        with self.lock:
+            self.voices.clear()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+
+def note_on(note, velocity=64, channel=0):
+    return event.Event.make("note_on", channel=channel, note=note, velocity=velocity)
+
+
+def note_off(note, channel=0):
+    return event.Event.make("note_off", channel=channel, note=note)
+
+
+class VoiceAllocatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock()
+        self.timers = MockTimers(self.clock)
+        self.stopped = []
+
+    def allocator(self, **kwargs):
+        return VoiceAllocator(self.timers, self.stopped.append, **kwargs)
+
+    def test_oldest(self):
+        allocator = self.allocator(polyphony=2)
+        allocator([note_on(60), note_on(64)])
+        self.assertEqual([note_off(60), note_on(67)], allocator([note_on(67)]))
+        self.assertEqual([], allocator([note_off(60)]))
+        self.assertEqual(2, len(allocator))
+
+    def test_quietest(self):
+        allocator = self.allocator(polyphony=2, stealing=QUIETEST)
+        allocator([note_on(60, 100), note_on(64, 20)])
+        self.assertEqual([note_off(64), note_on(67)], allocator([note_on(67)]))
+
+    def test_repeated_note(self):
+        allocator = self.allocator(polyphony=2)
+        allocator([note_on(60), note_on(60)])
+        # The second note_on needs a note_off of its own
+        self.assertEqual([note_off(60)], allocator([note_off(60)]))
+        self.assertEqual(1, len(allocator))
+        self.assertEqual([note_off(60)], allocator([note_off(60)]))
+        self.assertEqual([], allocator([note_off(60)]))
+        # A stolen voice is released as many times as it was struck
+        allocator([note_on(62), note_on(62), note_on(64)])
+        self.assertEqual([note_off(62), note_off(62), note_on(67)], allocator([note_on(67)]))
+
+    def test_max_duration(self):
+        allocator = self.allocator(max_duration=1.)
+        allocator([note_on(60)])
+        self.timers.run(0.5)
+        allocator([note_on(64)])
+        self.timers.run(1.2)
+        self.assertEqual([note_off(60)], self.stopped)
+        self.timers.run(2.)
+        self.assertEqual([note_off(60), note_off(64)], self.stopped)
+        self.assertEqual(0, len(allocator))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -44,6 +44,34 @@ DOUBLEBUF = "t" in parser.get("visual", "DOUBLEBUF").lower()
 
 mido_backend = parser.get("interface", "mido_backend")
 
+CACHE_DIRECTORY = os.path.join(directory, parser.get("cache", "directory"))
+
+
+def lane(name):
+    size, policy = [value.strip() for value in parser.get("lanes", name).split(",")]
+    return name, int(size), policy
+
+
+LANES = [lane(name) for name in ("effects", "notes", "control")]
+
+STOP_MODES = dict(parser.items("stop_mode"))
+
+BANDWIDTH_BYTES_PER_SECOND = int(parser.get("bandwidth", "bytes_per_second"))
+BANDWIDTH_BURST = int(parser.get("bandwidth", "burst"))
+BANDWIDTH_DROP = [name.strip() for name in parser.get("bandwidth", "drop").split(",") if name.strip()]
+
+LOOPS = {name: tuple(map(int, value.split(","))) for name, value in parser.items("loops")}
+
+AUTOMATION_MAX_RATE = float(parser.get("automation", "max_rate"))
+AUTOMATION_RAMP = float(parser.get("automation", "ramp"))
+
+VOICES_POLYPHONY = int(parser.get("voices", "polyphony"))
+VOICES_STEALING = parser.get("voices", "stealing").strip()
+VOICES_MAX_DURATION = float(parser.get("voices", "max_duration"))
+
+INSTRUMENTATION_ENABLED = "t" in parser.get("instrumentation", "enabled").lower()
+INSTRUMENTATION_PATH = os.path.join(directory, parser.get("instrumentation", "path"))
+
 SPACE_FIGHTER_PLAYER_VELOCITY = float(parser.get("space_fighter", "PLAYER_VELOCITY"))
 
 NOTES_PER_SIDE = int(parser.get("space_fighter", "NOTES_PER_SIDE"))
@@ -1,4 +1,4 @@
-from audio import audio, effect
+from audio import audio, effect, ports, preloader
 import messaging
 import signal
 import controller
@@ -10,15 +10,23 @@ logger = logging.getLogger(__name__)
 
 
 def note_on_listener(msg):
-    messaging.write(messaging.MidiMessage(msg))
+    messaging.write(messaging.MidiMessage(msg.to_message()))
 
 
-def create_track_and_combinator(track_path, configuration_path):
-    track = audio.Track(track_path, is_looping=True)
+def create_track(track_path):
+    return audio.Track(track_path, is_looping=True)
+
+
+def create_combinator(track, configuration_path):
     combinator = effect.Combinator(configuration_path, track)
     for channel in track.channels:
         channel.note_on_listener = note_on_listener
-    return track, combinator
+    return combinator
+
+
+def create_track_and_combinator(track_path, configuration_path):
+    track = create_track(track_path)
+    return track, create_combinator(track, configuration_path)
 
 
 class State(object):
@@ -26,6 +34,8 @@ class State(object):
         signal.signal(signal.SIGINT, self.stop)
 
         self.configuration_path = configuration_path
+        # Checks the configuration straight away so that a bad one fails now rather than at the first track change
+        effect.load_configuration(configuration_path)
         self.track_path = None
         self.track = None
         self.combinator = None
@@ -34,9 +44,29 @@ class State(object):
 
         self.last_on_buttons = []
 
+        # Prepares tracks in the background so that changing track does not leave a gap
+        self.preloader = preloader.TrackPreloader(self.create_track_with_name)
+        self.preloader.start()
+
+    def path_for_track_with_name(self, track_name):
+        return "{}/{}".format(self.media_path, track_name)
+
+    def create_track_with_name(self, track_name):
+        return create_track(self.path_for_track_with_name(track_name))
+
     def change_to_track_with_name(self, track_name):
-        self.track_path = "{}/{}".format(self.media_path, track_name)
-        self.track, self.combinator = create_track_and_combinator(self.track_path, self.configuration_path)
+        """
+        Change to a different track. If a track is already playing the new track takes over at the next bar.
+        :param track_name: The name of a midi file in the media directory
+        """
+        self.track_path = self.path_for_track_with_name(track_name)
+        track = self.preloader.get(track_name)
+        if self.combinator is not None:
+            self.combinator.stop()
+        if self.track is not None:
+            self.track.hand_off(track)
+        self.track = track
+        self.combinator = create_combinator(track, self.configuration_path)
 
     def stop(self):
         if self.track is not None:
@@ -74,32 +104,39 @@ class Normal(State):
 
         self.track_number = 0
         self.track_names = track_names
+        self.preload_neighbouring_tracks()
 
     @property
     def selected_track_name(self):
         return self.track_names[self.track_number % len(self.track_names)]
 
+    def track_name_at_offset(self, offset):
+        return self.track_names[(self.track_number + offset) % len(self.track_names)]
+
+    def preload_neighbouring_tracks(self):
+        """Prepare the tracks that start and select would change to"""
+        self.preloader.preload([self.track_name_at_offset(1), self.track_name_at_offset(-1)])
+
     def did_receive_on_buttons(self, buttons):
         super(Normal, self).did_receive_on_buttons(buttons)
         if controller.Button.start in buttons:
             self.track_number += 1
-            if self.track is not None:
-                self.track.stop()
             self.change_to_track_with_name(self.selected_track_name)
             self.track.start()
+            self.preload_neighbouring_tracks()
         elif controller.Button.select in buttons:
             self.track_number -= 1
-            if self.track is not None:
-                self.track.stop()
             self.change_to_track_with_name(self.selected_track_name)
             self.track.start()
+            self.preload_neighbouring_tracks()
         else:
             super(Normal, self).did_receive_on_buttons(buttons)
 
     def did_receive_new_on_buttons(self, buttons):
         super(Normal, self).did_receive_new_on_buttons(buttons)
         if len(buttons) > 0:
-            audio.set_program(15, program=116)
+            # In the same lane as the note so that the note cannot overtake it
+            audio.set_program(15, program=116, lane=ports.EFFECTS)
             audio.play_note_for_channel_note_velocity(15, velocity=127)
 
 
@@ -1,4 +1,3 @@
-import copy
 import math
 from Queue import Queue
 from os import path
@@ -122,8 +121,7 @@ class Side(object):
     def add_note(self, side_note):
         if side_note.channel == self.channels[self.state]:
             model_instance.notes.add(self.generator.make_note(side_note, self.colour))
-            side_note.channel = self.output_channel
-            track.channels[self.output_channel].send_message(side_note)
+            track.channels[self.output_channel].send_message(side_note.replace(channel=self.output_channel))
 
 
 # class DrumSide(Side):
@@ -175,10 +173,7 @@ while play:
         visual.make_score_notice(config.POINTS_PER_NOTE, note.position, 30, note.colour)
         visual.make_circle_explosion(visual.color.Color.GREY, 5, note.position)
 
-        midi_note = copy.copy(note.note)
-        midi_note.channel = 9
-        midi_note.time = 0
-        play_note(midi_note)
+        play_note(note.note.replace(channel=9))
 
     for side in sides:
         side.update()
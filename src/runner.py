@@ -1,9 +1,11 @@
 import logging
+from os import path
 
 import pygame
 
 import config
 import scoreboard
+from audio import audio, preloader
 from control import controller
 from space_fighter_game import space_fighter_game
 from visual import font
@@ -13,6 +15,11 @@ pygame.init()
 pygame.display.init()
 clock = pygame.time.Clock()
 
+directory = path.dirname(path.realpath(__file__))
+
+# How long the game track takes to fade into the high score track
+CROSSFADE_SECONDS = 2.
+
 
 def print_sprites():
     print "len(sprite_group_player) == {}".format(len(visual.sprite_group_player.sprites()))
@@ -33,18 +40,37 @@ def run_game(game):
         visual.draw()
         visual.sprite_group_notes.empty()
 
-    game.stop()
+
+def make_track(track_name):
+    return audio.Track("{}/media/audio/{}".format(directory, track_name), is_looping=True)
+
+
+def track_name_for_run(run_count):
+    return config.TRACK_NAMES[run_count % len(config.TRACK_NAMES)]
 
 
 def main():
     run_count = 0
+    # Prepares the next track while the current one is playing
+    track_preloader = preloader.TrackPreloader(make_track)
+    track_preloader.start()
+    score_track = None
     try:
         while True:
-            track_name = config.TRACK_NAMES[run_count % len(config.TRACK_NAMES)]
-            game = space_fighter_game.SpaceFighterGame(track_name)
+            track_name = track_name_for_run(run_count)
+            track = track_preloader.get(track_name)
+            track_preloader.preload([config.HIGH_SCORE_TRACK])
+            if score_track is not None:
+                # The game track takes over from the high score track at the next bar
+                score_track.hand_off(track)
+            game = space_fighter_game.SpaceFighterGame(track_name, track)
             run_game(game)
             font.notices_list = []
-            scoreboard.show_scoreboard(*game.scores)
+            score_track = track_preloader.get(config.HIGH_SCORE_TRACK)
+            # Fade the game track out under the high score track rather than cutting it off
+            audio.shared_mixer.crossfade(game.track, score_track, CROSSFADE_SECONDS)
+            track_preloader.preload([track_name_for_run(run_count + 1)])
+            scoreboard.show_scoreboard(*game.scores, track=score_track)
             font.notices_list = []
             run_count += 1
 
@@ -157,12 +157,21 @@ class Player(object):
             self.is_bored = True
 
 
-def show_scoreboard(player_one_score=None, player_two_score=None):
+def show_scoreboard(player_one_score=None, player_two_score=None, track=None):
+    """
+    Show the high scores until the players are done with them
+    :param player_one_score: A new score for player one
+    :param player_two_score: A new score for player two
+    :param track: A prepared high score track. It is left playing so that the caller can hand off from it to the
+    next track. If None a track is made and stopped here.
+    """
     global cycle
     scoreboard = Scoreboard("scores.txt")
 
-    track = audio.Track("{}/media/audio/{}".format(directory, config.HIGH_SCORE_TRACK), is_looping=True,
-                        play_notes=True)
+    is_own_track = track is None
+    if is_own_track:
+        track = audio.Track("{}/media/audio/{}".format(directory, config.HIGH_SCORE_TRACK), is_looping=True)
+    track.play_notes = True
     track.start()
     players = []
 
@@ -187,7 +196,8 @@ def show_scoreboard(player_one_score=None, player_two_score=None):
         visual.draw()
 
         if any(player.is_bored for player in players) and not any(player.is_active for player in players):
-            track.stop()
+            if is_own_track:
+                track.stop()
             break
 
 
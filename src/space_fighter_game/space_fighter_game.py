@@ -1,12 +1,12 @@
 from Queue import Queue
 from os import path
 
-import mido
-
 import config
 import model_space_fighter
 import visual.color
 from audio import audio as pl
+from audio import event
+from audio import ports
 from control import controller
 from visual import color
 from visual import font
@@ -17,19 +17,30 @@ directory = path.dirname(path.realpath(__file__))
 COLORS = [color.Color.FLIRT, color.Color.KEEN, color.Color.LIGHTNING, color.Color.SHAKA]
 
 
+def make_track(track_name):
+    return pl.Track("{}/../media/audio/{}".format(directory, track_name), is_looping=True, play_notes=False)
+
+
 class SpaceFighterGame(object):
-    def __init__(self, track_name):
+    def __init__(self, track_name, track=None):
+        """
+
+        :param track_name: The name of the midi file to play
+        :param track: A track for that file that has already been prepared (e.g. by a TrackPreloader)
+        """
         self.note_queue = Queue()
         self.model = model_space_fighter.SpaceFighterModel()
-        self.track = pl.Track("{}/../media/audio/{}".format(directory, track_name), is_looping=True,
-                              message_read_listener=self.message_read_listener, play_notes=False)
+        self.track = track if track is not None else make_track(track_name)
+        self.track.play_notes = False
+        self.track.message_read_listener = self.message_read_listener
         self.players = [Player(n, self.model.new_player(), self.track) for n in range(2)]
+        # The mode the track was last set up for
+        self.track_mode = None
 
     def message_read_listener(self, msg):
-        if msg.type == "note_on" and msg.channel in self.track.current_channels:
+        msg = self.track.route(msg)
+        if msg is not None and msg.type == "note_on":
             self.note_queue.put(msg)
-        for channel_mapper in self.track.channel_mappers:
-            channel_mapper.send_message(msg)
 
     def start(self):
         self.track.start()
@@ -58,10 +69,11 @@ class SpaceFighterGame(object):
             )
         for alien in self.model.dead_aliens:
             if alien.note.channel == 9:
-                self.track.channels[9].send_message(alien.note)
+                self.track.channels[9].send_message(alien.note, lane=ports.EFFECTS)
             else:
                 self.track.sound_effects_channel.send_message(
-                    mido.Message("note_on", channel=config.SOUND_EFFECTS_CHANNEL, note=alien.note.note, velocity=80))
+                    event.Event.make("note_on", channel=config.SOUND_EFFECTS_CHANNEL, note=alien.note.note,
+                                     velocity=80), lane=ports.EFFECTS)
             visual.make_circle_explosion(
                 position=(
                     alien.position[0] - visual.note_sprite_sheet.shape[0] / 2,
@@ -69,11 +81,20 @@ class SpaceFighterGame(object):
                 )
             )
 
+        mode = self.mode
+        if mode != self.track_mode:
+            self.set_track_mode(mode)
+
+    def set_track_mode(self, mode):
+        """
+        Change the routing and tempo of the track to suit a mode. The pitch ratios in config.PITCH are left alone: a
+        fifth is beyond the pitchwheel range of the synths and bending every channel would bend the drums too.
+        :param mode: The index of the mode (see config.LIMITS)
+        """
+        self.track_mode = mode
         for mapper in self.track.channel_mappers:
-            mapper.mode = self.mode
-            self.track.tempo_shift = config.TEMPO[self.mode]
-            for channel in self.track.channels:
-                channel.pitch_bend = config.PITCH[self.mode]
+            mapper.mode = mode
+        self.track.tempo_shift = config.TEMPO[mode]
 
     @property
     def mode(self):
@@ -159,7 +180,8 @@ class Player(object):
             elif button in ("a", "b"):
                 self.model_player.fire()
                 self.track.sound_effects_channel.send_message(
-                    mido.Message("note_on", channel=config.SOUND_EFFECTS_CHANNEL, note=0, velocity=80))
+                    event.Event.make("note_on", channel=config.SOUND_EFFECTS_CHANNEL, note=0, velocity=80),
+                    lane=ports.EFFECTS)
         elif button != "centre":
             self.is_started = True
             self.cursor = visual.PlayerCursor(color=self.color)